@@ -1,5 +1,42 @@
 const fetch = require('node-fetch');
 
+// typed arrays for the column types of the server's binary responses
+const BINARY_ARRAYS = {
+    '<i4': Int32Array,
+    '<i8': BigInt64Array,
+    '<f4': Float32Array,
+    '<f8': Float64Array
+};
+
+/**
+ * Decode a binary ('GTKB') response into typed arrays, one per column,
+ * that share the response's buffer. Nx3 columns are flat arrays of
+ * 3N values, ready to be used as a THREE.BufferAttribute with itemSize 3.
+ *
+ * @param {ArrayBuffer} buffer
+ * @returns {{columns: Object, shapes: Object, metadata: Object}}
+ */
+function decodeBinary(buffer) {
+    const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+    if (magic !== 'GTKB') {
+        throw new Error('not a GTK binary payload');
+    }
+
+    const hlength = new DataView(buffer).getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, hlength)));
+    const base = 8 + hlength;
+
+    const columns = {};
+    const shapes = {};
+    for (const c of header.columns) {
+        const count = c.shape.reduce((a, b) => a * b, 1);
+        columns[c.name] = new BINARY_ARRAYS[c.dtype](buffer, base + c.offset, count);
+        shapes[c.name] = c.shape;
+    }
+
+    return { columns: columns, shapes: shapes, metadata: header.metadata };
+}
+
 /**
  * Class Client
  *
@@ -17,6 +54,12 @@ class Client {
         if (options && options.auth) {
             this.auth = `Basic ${Buffer.from(options.auth).toString("base64")}`
         }
+
+        // responses are kept in memory (up to cacheBytes characters of
+        // JSON), and revalidated with the server through their ETag
+        this.cacheBytes = (options && options.cacheBytes !== undefined) ? options.cacheBytes : 64*1024*1024;
+        this.cache = new Map();
+        this.cacheSize = 0;
     }
 
     set data(d) {
@@ -29,17 +72,91 @@ class Client {
 
     _fetch(path, callback) {
         const url = this.host !== undefined ? new URL(path, this.host) : path;
-        const options = this.auth ? {
-            headers: {
-                'Authorization': this.auth
+        const key = url.toString();
+        const headers = {};
+        if (this.auth) {
+            headers['Authorization'] = this.auth;
+        }
+
+        const cached = this.cache.get(key);
+        if (cached) {
+            headers['If-None-Match'] = cached.etag;
+        }
+
+        fetch(url, { headers: headers })
+            .then(response => {
+                if (response.status === 304 && cached) {
+                    // move to the end, as the most recently used
+                    this.cache.delete(key);
+                    this.cache.set(key, cached);
+                    return cached.text;
+                }
+
+                const etag = response.headers.get('ETag');
+                return response.text().then(text => {
+                    if (etag) {
+                        this._cache_put(key, etag, text);
+                    }
+                    return text;
+                });
+            })
+            .then(text => callback(JSON.parse(text)));
+    }
+
+    _fetch_binary(path, callback) {
+        const url = this.host !== undefined ? new URL(path, this.host) : path;
+        const headers = { 'Accept': 'application/octet-stream' };
+        if (this.auth) {
+            headers['Authorization'] = this.auth;
+        }
+
+        fetch(url, { headers: headers })
+            .then(response => response.arrayBuffer())
+            .then(buffer => callback(decodeBinary(buffer)));
+    }
+
+    _cache_put(key, etag, text) {
+        if (this.cache.has(key)) {
+            this.cacheSize -= this.cache.get(key).text.length;
+            this.cache.delete(key);
+        }
+        if (text.length > this.cacheBytes) {
+            return;
+        }
+
+        this.cache.set(key, { etag: etag, text: text });
+        this.cacheSize += text.length;
+
+        // evict the least recently used
+        for (const [oldest, entry] of this.cache) {
+            if (this.cacheSize <= this.cacheBytes) {
+                break;
             }
-        } : undefined;
+            this.cache.delete(oldest);
+            this.cacheSize -= entry.text.length;
+        }
+    }
 
-        fetch(url, options)
+    _post(path, payload, callback) {
+        const url = this.host !== undefined ? new URL(path, this.host) : path;
+        const headers = { 'Content-Type': 'application/json' };
+        if (this.auth) {
+            headers['Authorization'] = this.auth;
+        }
+
+        fetch(url, { method: 'POST', headers: headers, body: JSON.stringify(payload) })
             .then(response => response.json())
             .then(data => callback(data));
     }
 
+    //
+    // run several queries in one request. The callback receives a list
+    // of results ({path, status, data}) in the order of the paths
+    //
+    batch(callback, paths) {
+        this._post('/batch', paths, data => callback(data.results));
+    }
+
     get_project(callback) {
         this._fetch('/project/project.json', callback);
     }
@@ -93,6 +210,28 @@ class Client {
         this._fetch(`/genes/${genes}/data/structure/${structureID}`, callback);
     }
 
+    //
+    // get the segments near a list of segments, a list of genes or a
+    // point ([x, y, z]): within radius, or the k nearest. The callback
+    // receives {'segments': [...], 'genes': [...]}
+    //
+    get_neighbors_of_segments(callback, structureID, segIDs, radius, k) {
+        this._fetch_neighbors(callback, `/data/structure/${structureID}/neighbors/segment/${segIDs}`, radius, k);
+    }
+
+    get_neighbors_of_genes(callback, structureID, genes, radius, k) {
+        this._fetch_neighbors(callback, `/data/structure/${structureID}/neighbors/gene/${genes}`, radius, k);
+    }
+
+    get_neighbors_of_point(callback, structureID, point, radius, k) {
+        this._fetch_neighbors(callback, `/data/structure/${structureID}/neighbors/point/${point.join(',')}`, radius, k);
+    }
+
+    _fetch_neighbors(callback, path, radius, k) {
+        const query = (radius !== undefined && radius !== null) ? `?radius=${radius}` : `?k=${k}`;
+        this._fetch(path + query, callback);
+    }
+
     //
     // get the contactmap for an id 
     //
@@ -100,6 +239,20 @@ class Client {
         this._fetch(`/data/contact-map/${cmID}`, callback);
     }
 
+    //
+    // get the zoom levels of the tiled contact map for an id
+    //
+    get_contactmap_tiles(callback, cmID) {
+        this._fetch(`/data/contact-map/${cmID}/tiles`, callback);
+    }
+
+    //
+    // get one tile of a contact map at a zoom level
+    //
+    get_contactmap_tile(callback, cmID, zoom, tx, ty) {
+        this._fetch(`/data/contact-map/${cmID}/tile/${zoom}/${tx}/${ty}`, callback);
+    }
+
 
     //
     // get the structure for an ID
@@ -108,6 +261,14 @@ class Client {
         this._fetch(`/data/structure/${structureID}/segments`, callback);
     }
 
+    //
+    // get the structure for an ID as typed arrays: segid, startid, endid
+    // and length, and the start, end and center points (3 values each)
+    //
+    get_structure_buffers(callback, structureID) {
+        this._fetch_binary(`/data/structure/${structureID}/segments`, data => callback(data.columns));
+    }
+
     //
     // get the unmapped segments for a structure 
     //
@@ -151,10 +312,25 @@ class Client {
     }
 
     //
+    // get at most numsamples values for a range of an array, each one
+    // summarising a bin of the range ('mean' by default, 'min', 'max' or 'coverage')
     //
+    get_sampled_array(callback, arrayID, arraySlice, begin, end, numsamples, summary) {
+        const query = summary ? `?summary=${summary}` : '';
+        this._fetch(`/data/samplearray/${arrayID}/${arraySlice}/${begin}/${end}/${numsamples}${query}`, callback);
+    }
+
+    //
+    // get sampled data for several windows at once. Each query is
+    // [arrayID, arraySlice, begin, end]; the callback receives
+    // {'data': [...]}, with the samples of each query in order
     //
-    get_sampled_array(callback, arrayID, arraySlice, begin, end, numsamples) {
-        this._fetch(`/data/samplearray/${arrayID}/${arraySlice}/${begin}/${end}/${numsamples}`, callback);
+    get_sampled_arrays(callback, queries, numsamples, summary) {
+        const payload = { 'numsamples': numsamples, 'queries': queries };
+        if (summary) {
+            payload['summary'] = summary;
+        }
+        this._post('/data/samplearrays', payload, callback);
     }
 
 }
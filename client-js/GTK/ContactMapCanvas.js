@@ -32,6 +32,7 @@ const Component = require('./Component');
 const Project = require('./Project');
 const Dataset = require('./Dataset');
 const ContactMap = require('./ContactMap');
+const ContactMapTiles = require('./ContactMapTiles');
 const Util = require('./Util');
 const ScalarBarCanvas = require('./ScalarBarCanvas');
 
@@ -119,7 +120,8 @@ class ContactMapCanvas extends Component {
      * 
      * Once constructed, this will automatically begin fetching and loading the contact map
      * data in the background. The full widget will appear with everything enabled once loading
-     * has finished.
+     * has finished. If the contact map has a tile pyramid, only the tiles covering the viewport
+     * are fetched, at a resolution matching the zoom; otherwise the whole contact map is.
      *
      * @param {Project} project The Project this belongs to
      * @param {Dataset} dataset The Dataset containing the contact map this will display
@@ -236,7 +238,7 @@ class ContactMapCanvas extends Component {
         // the data loads
 
         /**
-         * @type {ContactMap} The contact map data.
+         * @type {ContactMap|ContactMapTiles} The contact map data, or its tile pyramid.
          * This is null when first constructed, but will be set once data has finished loading
          */
         this.contactMap = null;
@@ -244,9 +246,16 @@ class ContactMapCanvas extends Component {
         /**
          * @type {ImageData} The contact map rendered to ImageData (one pixel per segment)
          * This is null when first constructed, but will be set once data has finished loading
+         * (and stays null if the contact map is drawn from tiles)
          */
         this.imageData = null;
 
+        /**
+         * The tiles rendered so far (one pixel per bin), by ContactMapTiles.key.
+         * These are cleared when the colormap changes.
+         */
+        this.tileImages = new Map();
+
         /**
          * A d3 scale mapping (fractional) segment numbers to pixels on the canvas along the x-axis.
          * This is null when first constructed, but will be set once data has finished loading
@@ -328,8 +337,10 @@ class ContactMapCanvas extends Component {
             .on('click', () => this._clearBrushes() );
         this.boundingDiv.appendChild(this.clearButton.node());
 
-        // Load data
-        ContactMap.loadNew( dataset.md_contact_mp ).then( (contactMap) => {
+        // Load data (the whole contact map if it has no tiles)
+        ContactMapTiles.loadNew( dataset.md_contact_mp ).then( (tiles) => {
+            return tiles || ContactMap.loadNew( dataset.md_contact_mp );
+        }).then( (contactMap) => {
             /***********************************************************************
              * This chunk is called after the contact map data has finished loading
             *************************************************************************/
@@ -429,7 +440,11 @@ class ContactMapCanvas extends Component {
         this.lut.setMin(0.01 * max);
         this.scalarBarCanvas.redraw();
 
-        this.imageData = this._renderToImageData(this.contactMap, value);
+        if (this.contactMap instanceof ContactMapTiles) {
+            this.tileImages = new Map();
+        } else {
+            this.imageData = this._renderToImageData(this.contactMap, value);
+        }
         this._redrawCanvas();
     }
 
@@ -592,29 +607,62 @@ class ContactMapCanvas extends Component {
         const pixels = new Uint8ClampedArray(cm.data.length * 4);
 
         for (let i = 0; i < pixels.length; i+= 4) {
-            const val = cm.data[i/4];
-
-            // color using the lut 
-            if (val <= this.lut.minV) {
-                // Pixels below the threshold are transparent
-                pixels[i+3] = 0;
-            } else {
-                const color = this.lut.getColor(val);
-                pixels[i]   = color.r*(255);
-                pixels[i+1] = color.g*(255);
-                pixels[i+2] = color.b*(255);
-                pixels[i+3] = 255; 
-            }
+            this._colorPixel(pixels, i, cm.data[i/4]);
         }
 
         return new ImageData(pixels, cm.bounds.width, cm.bounds.height);
     }
 
+    /**
+     * Render a tile of a contact map to a canvas (one pixel per bin)
+     * @param {Object} tile The tile, as returned by Client.get_contactmap_tile
+     * @returns {HTMLCanvasElement}
+     */
+    _renderTile(tile) {
+        const size   = tile.tile_size;
+        const pixels = new Uint8ClampedArray(size * size * 4);
+
+        for (let c of tile.contacts) {
+            // x and y are the first record in the bin
+            const lx = (c.x - 1) / tile.bin_size - tile.tx * size;
+            const ly = (c.y - 1) / tile.bin_size - tile.ty * size;
+            this._colorPixel(pixels, (ly * size + lx) * 4, c.value);
+        }
+
+        const canvas = document.createElement("canvas");
+        canvas.width  = size;
+        canvas.height = size;
+        canvas.getContext('2d').putImageData(new ImageData(pixels, size, size), 0, 0);
+        return canvas;
+    }
+
+    /**
+     * Set the RGBA pixel at index i to the color of a value
+     */
+    _colorPixel(pixels, i, val) {
+        // color using the lut 
+        if (val <= this.lut.minV) {
+            // Pixels below the threshold are transparent
+            pixels[i+3] = 0;
+        } else {
+            const color = this.lut.getColor(val);
+            pixels[i]   = color.r*(255);
+            pixels[i+1] = color.g*(255);
+            pixels[i+2] = color.b*(255);
+            pixels[i+3] = 255; 
+        }
+    }
+
     /**
      * Repaint the contact map onto the canvas.
      * Should call this any time the viewport is zoomed or panned
      */
     _redrawCanvas() {
+        if (this.contactMap instanceof ContactMapTiles) {
+            this._redrawTiles();
+            return;
+        }
+
         const img = this.imageData;
         if (img === null) return;
 
@@ -641,6 +689,49 @@ class ContactMapCanvas extends Component {
         ctx.restore();
     }
 
+    /**
+     * Repaint the tiles covering the viewport onto the canvas, at the zoom level whose
+     * bins are closest to a pixel. Tiles that haven't been fetched yet are fetched, and
+     * the canvas is repainted as they arrive; until then, the zoom 0 tile (drawn first,
+     * underneath the others) fills in for them.
+     */
+    _redrawTiles() {
+        const cm = this.contactMap;
+        const [ x1, x2 ] = this.xScale.domain();
+        const [ y1, y2 ] = this.yScale.domain();
+
+        const zoom  = cm.zoomFor( (x2 - x1) / this.margin.innerWidth );
+        const tiles = cm.tilesCovering(zoom, x1, x2, y1, y2).map( ([tx, ty]) => [zoom, tx, ty] );
+        if (zoom > 0) tiles.unshift([0, 0, 0]);
+
+        const ctx = this.canvas.node().getContext('2d');
+        ctx.fillStyle = this.background; 
+        ctx.fillRect(0, 0, this.margin.innerWidth, this.margin.innerHeight);
+        ctx.imageSmoothingEnabled = false;
+
+        for (let [z, tx, ty] of tiles) {
+            const key  = ContactMapTiles.key(z, tx, ty);
+            const tile = cm.tiles.get(key);
+            if (tile === undefined) {
+                cm.fetchTile(z, tx, ty, () => this._redrawCanvas());
+                continue;
+            }
+
+            let image = this.tileImages.get(key);
+            if (image === undefined) {
+                image = this._renderTile(tile);
+                this.tileImages.set(key, image);
+            }
+
+            // the tile covers records first to first + span (exclusive)
+            const span  = cm.tileSize * cm.binSize(z);
+            const left  = this.xScale(tx * span + 1);
+            const top   = this.yScale(ty * span + 1);
+            ctx.drawImage(image, left, top,
+                          this.xScale((tx+1) * span + 1) - left, this.yScale((ty+1) * span + 1) - top);
+        }
+    }
+
     /**
      * Convert a pair of brush coordinates to a pair of segment ranges. The units for the
      * brush coordinates *MUST* be in segment numbers, *NOT* pixels.
@@ -0,0 +1,175 @@
+/*
+Copyright (c) 2021, Triad National Security, LLC. All rights reserved.
+  
+Redistribution and use in source and binary forms, with or
+without modification, are permitted provided that the following conditions
+are met:
+    1. Redistributions of source code must retain the above copyright notice, 
+       this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+       notice, this list of conditions and the following disclaimer in the
+       documentation and/or other materials provided with the distribution.
+
+    3. Neither the name of Los Alamos National Security, LLC, Los Alamos
+       National Laboratory, LANL, the U.S. Government, nor the names of its
+       contributors may be used to endorse or promote products derived from 
+       this software without specific prior written permission.
+    
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS CONTRIBUTORS "AS IS" AND 
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED 
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE 
+DISCLAIMED. IN NO EVENT SHALL LOS ALAMOS NATIONAL SECURITY, LLC OR CONTRIBUTORS 
+BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE 
+GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT 
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF
+THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+*/
+
+const Client = require("./Client");
+
+/**
+ * @class ContactMapTiles
+ * 
+ * Represents the tile pyramid of a contact map. Instead of the whole contact map, the
+ * ContactMapCanvas fetches the tiles covering its viewport, at the zoom level whose bins
+ * are closest to the size of a pixel.
+ * 
+ * At zoom level z, a bin covers binSize(z) records along each axis, and a tile covers
+ * tileSize bins. Zoom 0 covers the whole contact map in one tile; it is fetched when the
+ * instance is loaded, and gives the bounds and value range of the contact map.
+ */
+class ContactMapTiles {
+
+    /**
+     * Please don't call this directly, instead call the static loadNew function
+     * which will fetch the pyramid for you and give a Promise resolving into one of these instances.
+     * @param {String} id
+     * @param {Object} pyramid The contact map's zoom levels (as returned by Client.get_contactmap_tiles)
+     * @param {Object} overview The tile at zoom 0
+     */
+    constructor(id, pyramid, overview) {
+        this.id = id;
+
+        /** The number of bins along each side of a tile */
+        this.tileSize = pyramid.tile_size;
+
+        /** The number of zoom levels */
+        this.levels = pyramid.levels.length;
+
+        /**
+         * The boundaries of the x/y coodinates of the data, in the same form as ContactMap.bounds
+         */
+        this.bounds = {
+            x: 1,
+            y: 1,
+            x2: pyramid.size,
+            y2: pyramid.size,
+            width: pyramid.size,
+            height: pyramid.size
+        }
+
+        /**
+         * The minimum and maximum values of the bins at zoom 0. These are means over many
+         * records, so the bins of finer zoom levels can fall outside of this range.
+         */
+        this.minValue = Number.MAX_VALUE;
+        this.maxValue = Number.MIN_VALUE;
+        for (let c of overview.contacts) {
+            if (c.value < this.minValue) this.minValue = c.value;
+            if (c.value > this.maxValue) this.maxValue = c.value;
+        }
+
+        /** The tiles fetched so far, by ContactMapTiles.key */
+        this.tiles = new Map();
+        this.tiles.set(ContactMapTiles.key(0, 0, 0), overview);
+
+        /** The keys of the tiles being fetched */
+        this.pending = new Set();
+    }
+
+    static key(zoom, tx, ty) {
+        return `${zoom}/${tx}/${ty}`;
+    }
+
+    /**
+     * The number of records along each axis covered by a bin at a zoom level
+     */
+    binSize(zoom) {
+        return 1 << (this.levels - 1 - zoom);
+    }
+
+    /**
+     * The coarsest zoom level whose bins cover no more than the given number of records
+     * (the finest level if they all do)
+     */
+    zoomFor(records) {
+        const steps = Math.floor( Math.log2( Math.max(records, 1) ) );
+        return Math.max( this.levels - 1 - steps, 0 );
+    }
+
+    /**
+     * The [tx, ty] of the tiles at a zoom level that cover records x1 to x2 and y1 to y2
+     */
+    tilesCovering(zoom, x1, x2, y1, y2) {
+        const span = this.tileSize * this.binSize(zoom);
+        const last = Math.floor( (this.bounds.x2 - 1) / span );
+        const tile = (r) => Math.min( Math.max( Math.floor( (r - 1) / span ), 0 ), last );
+
+        const tiles = [];
+        for (let ty = tile(y1); ty <= tile(y2); ty++) {
+            for (let tx = tile(x1); tx <= tile(x2); tx++) {
+                tiles.push([ tx, ty ]);
+            }
+        }
+        return tiles;
+    }
+
+    /**
+     * Fetch a tile, unless it has been fetched already or is being fetched, and call
+     * the callback with it once it arrives
+     */
+    fetchTile(zoom, tx, ty, callback) {
+        const key = ContactMapTiles.key(zoom, tx, ty);
+        if (this.tiles.has(key) || this.pending.has(key)) return;
+
+        this.pending.add(key);
+        Client.TheClient.get_contactmap_tile( (tile) => {
+            this.pending.delete(key);
+            this.tiles.set(key, tile);
+            callback(tile);
+        }, this.id, zoom, tx, ty);
+    }
+
+    /**
+     * Fetch the pyramid of the contact map with the given id in the project and load a new
+     * instance of ContactMapTiles from it. Returns a promise that resolves into the new
+     * instance, or into null if the contact map has no pyramid (as in databases built
+     * before there were tiles).
+     * @param {String} id
+     * @returns {Promise<ContactMapTiles>} 
+     */
+    static loadNew(id) {
+        return new Promise( (resolve, reject) => {
+            try {
+                Client.TheClient.get_contactmap_tiles( (pyramid) => {
+                    if (pyramid.levels.length === 0) {
+                        resolve(null);
+                        return;
+                    }
+
+                    Client.TheClient.get_contactmap_tile( (overview) => {
+                        resolve( new ContactMapTiles(id, pyramid, overview) )
+                    }, id, 0, 0, 0);
+                }, id);
+            }
+            catch (err) {
+                reject(err);
+            }
+        });
+    }
+}
+
+module.exports = ContactMapTiles;
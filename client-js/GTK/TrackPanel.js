@@ -73,7 +73,10 @@ class TrackPanel extends Component {
             this.charts.removeChild(this.charts.firstChild);
         }
 
-        // Populate tracks
+        // Populate tracks: the data for every track (and both datasets)
+        // is fetched in one request
+        const queries = [];
+        const panels = [];
         for (let track of tracks) {
             const {variable, locationRange} = track;
             const [start, end] = locationRange;
@@ -86,31 +89,35 @@ class TrackPanel extends Component {
             cont.innerText = title;
             this.charts.insertBefore(cont, this.charts.firstChild);
 
-            // Function to fetch data and create chart
-            const make_chart = (index) => new Promise( (resolve, reject) => {
-                Client.TheClient.get_sampled_array( (response) => { try {
-                    const data = response['data'];
-    
+            panels.push({ cont: cont, start: start, end: end });
+            for (let index of [0, 1]) {
+                queries.push([variable, index, start, end]);
+            }
+        }
+
+        if (queries.length == 0) return;
+
+        Client.TheClient.get_sampled_arrays( (response) => {
+            panels.forEach( (panel, p) => {
+                const {cont, start, end} = panel;
+
+                // Create charts
+                for (let index of [0, 1]) {
+                    const data = response['data'][2*p + index];
+
                     // Create chart labels
                     const labels = [];
                     const incr = Math.max( (end-start)/data.length, 1);
                     for (let i = start; i < end; i += incr)
                         labels.push[i];
-    
+
                     // Build chart
                     const chart = new TrackChart( this.titles[index] );
                     cont.appendChild(chart.element);
                     chart.make(labels, data);
-
-                    resolve();
-
-                } catch (e) { reject(e); }
-                }, variable, index, locationRange[0], locationRange[1], 200);
+                }
             });
-
-            // Create charts
-            make_chart(0).then( () => make_chart(1) );
-        }
+        }, queries, 200);
     }
 
 }
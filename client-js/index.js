@@ -10,6 +10,7 @@ module.exports = {
     Component:          require('./GTK/Component'),
     ContactMap:         require('./GTK/ContactMap'),
     ContactMapCanvas:   require('./GTK/ContactMapCanvas'),
+    ContactMapTiles:    require('./GTK/ContactMapTiles'),
     Controller:         require('./GTK/Controller'),
     Dataset:            require('./GTK/Dataset'),
     GeometryCanvas:     require('./GTK/GeometryCanvas'),
@@ -1,15 +1,150 @@
+import io
 import json
 import sys
+import struct
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import numpy
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BINARY_MIMETYPE = 'application/octet-stream'
+BINARY_MAGIC    = b'GTKB'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+#
+# encode an array in .npy format, for upload
+#
+def encode_npy(array):
+    buffer = io.BytesIO()
+    numpy.save(buffer, numpy.asarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+def neighbor_query(radius, k):
+    return f'?radius={radius}' if radius is not None else f'?k={k}'
+
+#
+# decode a binary response from the server into a dictionary of
+# numpy arrays (one per column) and the metadata from its header
+#
+def decode_binary(content):
+    if content[0:4] != BINARY_MAGIC:
+        raise ValueError("not a GTK binary payload")
+
+    (hlength,) = struct.unpack('<I', content[4:8])
+    header = json.loads(content[8:8 + hlength].decode('utf-8'))
+    base   = 8 + hlength
+
+    columns = {}
+    for c in header['columns']:
+        dtype = numpy.dtype(c['dtype'])
+        count = int(numpy.prod(c['shape']))
+        columns[c['name']] = numpy.frombuffer(
+            content, dtype=dtype, count=count, offset=base + c['offset']
+        ).reshape(c['shape'])
+
+    return columns, header['metadata']
+
+#
+# An on-disk cache of server responses, keyed by URL and format
+#
+# Each entry holds the body of a response and its ETag; the client sends
+# the ETag back with If-None-Match and reuses the body when the server
+# answers 304. Once the entries take more than max_bytes, the least
+# recently used are removed.
+#
+class ResponseCache:
+
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self._lock     = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, url, accept):
+        key = hashlib.sha256(f'{accept} {url}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key)
+
+    # returns (etag, body), or (None, None) if the URL is not cached
+    def get(self, url, accept):
+        fname = self._path(url, accept)
+        try:
+            with open(fname, 'rb') as cfile:
+                etag = cfile.readline().decode('utf-8').rstrip('\n')
+                body = cfile.read()
+        except OSError:
+            return None, None
+
+        # mark as recently used
+        os.utime(fname)
+        return etag, body
+
+    def put(self, url, accept, etag, body):
+        fname = self._path(url, accept)
+        (fd, tmpname) = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as cfile:
+            cfile.write(etag.encode('utf-8') + b'\n')
+            cfile.write(body)
+        os.replace(tmpname, fname)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.startswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(e[1] for e in entries)
+            for (mtime, size, fname) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+                total -= size
 
 class client:
 
+    #
+    # keyword arguments:
+    #   auth        'user:password' for basic authentication
+    #   workers     number of requests the bulk methods run at once (default 8)
+    #   retries     times a failed GET is retried, with backoff (default 3)
+    #   cache_dir   directory for an on-disk cache of responses (default: no cache)
+    #   cache_mb    size limit of the on-disk cache (default 1024)
+    #
     def __init__(self, url, port, **kwargs):
         self.port = port
         self.url  = url
         self.project = ""
+        self.workers = kwargs.get('workers', 8)
+        self._executor = None
+
+        self.cache = None
+        if kwargs.get('cache_dir'):
+            self.cache = ResponseCache(kwargs['cache_dir'], kwargs.get('cache_mb', 1024) * 1024 * 1024)
+
+        # keep-alive connections for every worker, and retries for
+        # dropped connections and busy servers
+        retry = Retry(
+                    total=kwargs.get('retries', 3),
+                    backoff_factor=0.2,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=['GET']
+                )
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry)
 
         self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
         if 'auth' in kwargs:
             self.session.auth = tuple(kwargs['auth'].split(':'))
@@ -38,12 +173,56 @@ class client:
     def port(self, value):
         self._port = value
 
-    def _request(self, path):
+    # call function on each item, running up to self.workers at once;
+    # returns the results in the order of the items
+    def map(self, function, items):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        return list(self._executor.map(function, items))
+
+    # GET a path, revalidating against the cache when there is one
+    def _get(self, path, accept):
         if path[0] == '/':
             path = path[1:]
-        response = self.session.get(f'{self.url}:{self.port}/{path}')
+        url = f'{self.url}:{self.port}/{path}'
 
-        return response.json()
+        headers = {'Accept': accept}
+        (etag, body) = (None, None)
+        if self.cache is not None:
+            (etag, body) = self.cache.get(url, accept)
+            if etag is not None:
+                headers['If-None-Match'] = etag
+
+        response = self.session.get(url, headers=headers)
+        if (response.status_code == 304) and (body is not None):
+            return response, body
+
+        if (self.cache is not None) and (response.status_code == 200) and ('ETag' in response.headers):
+            self.cache.put(url, accept, response.headers['ETag'], response.content)
+
+        return response, response.content
+
+    def _request(self, path):
+        (response, body) = self._get(path, 'application/json')
+
+        return json.loads(body)
+
+    def _binaryrequest(self, path):
+        (response, body) = self._get(path, BINARY_MIMETYPE)
+        response.raise_for_status()
+
+        return decode_binary(body)
+
+    # GET a path as NDJSON, yielding its records as they arrive (not cached)
+    def _streamrequest(self, path):
+        if path[0] == '/':
+            path = path[1:]
+        with self.session.get(f'{self.url}:{self.port}/{path}', headers={'Accept': NDJSON_MIMETYPE}, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
 
     def _postrequest(self, path, payload):
         if path[0] == ('/'):
@@ -52,6 +231,18 @@ class client:
 
         return response.json()
 
+    # run several queries in one request. Returns a list of results
+    # ({'path', 'status', 'data'}) in the order of the paths; binary
+    # answers are returned as bytes (see decode_binary)
+    def batch(self, paths):
+        results = self._postrequest('batch', list(paths))['results']
+        for r in results:
+            if r.get('encoding') == 'base64':
+                r['data'] = base64.b64decode(r['data'])
+                del r['encoding']
+
+        return results
+
     def get_project_interval(self):
         return self._request('project/interval')
 
@@ -76,6 +267,18 @@ class client:
     def get_segments_for_genes(self, structureID, gene):
         return self._request(f'genes/{gene}/data/structure/{structureID}')
 
+    # the segments near some segments, genes or a point (x, y, z): those
+    # within radius, or the k nearest to each. Returns {'segments', 'genes'}
+    def get_neighbors_of_segments(self, structureID, segIDs, radius=None, k=None):
+        return self._request(f'data/structure/{structureID}/neighbors/segment/{segIDs}{neighbor_query(radius, k)}')
+
+    def get_neighbors_of_genes(self, structureID, genes, radius=None, k=None):
+        return self._request(f'data/structure/{structureID}/neighbors/gene/{genes}{neighbor_query(radius, k)}')
+
+    def get_neighbors_of_point(self, structureID, point, radius=None, k=None):
+        point = ','.join(str(float(v)) for v in point)
+        return self._request(f'data/structure/{structureID}/neighbors/point/{point}{neighbor_query(radius, k)}')
+
     def get_structure_arrays(self):
         return self.get_arrays('structure')
 
@@ -91,19 +294,87 @@ class client:
     def get_contactmap(self, cmID):
         return self._request(f'data/contact-map/{cmID}')
 
+    # the records of a contact map, one at a time, without holding the whole map
+    def iter_contactmap(self, cmID):
+        return self._streamrequest(f'data/contact-map/{cmID}')
+
+    def iter_genes(self):
+        return self._streamrequest('genes')
+
+    def get_array_numpy(self, arrayID, arraySlice):
+        columns, metadata = self._binaryrequest(f'data/array/{arrayID}/{arraySlice}')
+        return columns['values']
+
+    def get_structure_numpy(self, structureID):
+        columns, metadata = self._binaryrequest(f'data/structure/{structureID}/segments')
+        return columns
+
+    def get_contactmap_numpy(self, cmID):
+        columns, metadata = self._binaryrequest(f'data/contact-map/{cmID}')
+        return columns
+
+    def get_contactmap_tiles(self, cmID):
+        return self._request(f'data/contact-map/{cmID}/tiles')
+
+    def get_contactmap_tile(self, cmID, zoom, tx, ty):
+        return self._request(f'data/contact-map/{cmID}/tile/{zoom}/{tx}/{ty}')
+
+    def get_contactmap_tile_numpy(self, cmID, zoom, tx, ty):
+        columns, metadata = self._binaryrequest(f'data/contact-map/{cmID}/tile/{zoom}/{tx}/{ty}')
+        return columns
+
+    # array is a list, a numpy array, or a dictionary of numpy arrays
+    # keyed by dataset ID; numpy arrays are sent as .npy files
     def set_array(self, array, params):
-        # send the data to the server
-        data = params
-        data["array"] = array
-        
-        response = self._postrequest('data/setarray', data)
-        return response["id"]
+        url = f'{self.url}:{self.port}/data/setarray'
+        if isinstance(array, numpy.ndarray):
+            response = self.session.post(url, params=params, data=encode_npy(array),
+                                         headers={'Content-Type': BINARY_MIMETYPE})
+        elif isinstance(array, dict):
+            files = { str(d): (f'{d}.npy', encode_npy(a), BINARY_MIMETYPE) for (d, a) in array.items() }
+            response = self.session.post(url, data=params, files=files)
+        else:
+            # send the data to the server
+            data = dict(params)
+            data["array"] = array
+            response = self.session.post(url, json=data)
 
-    def get_sampled_array(self, arrayID, arraySlice, begin, end, numsamples ):
-        return self._request(f'data/samplearray/{arrayID}/{arraySlice}/{begin}/{end}/{numsamples}')
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def get_sampled_array(self, arrayID, arraySlice, begin, end, numsamples, summary=None ):
+        query = f'?summary={summary}' if summary else ''
+        return self._request(f'data/samplearray/{arrayID}/{arraySlice}/{begin}/{end}/{numsamples}{query}')
+
+    # sample several windows, each (arrayID, arraySlice, begin, end), in one
+    # request; returns a numpy array of samples for each, in the same order
+    def get_sampled_arrays(self, queries, numsamples, summary=None):
+        payload = { 'numsamples': numsamples, 'queries': [ list(q) for q in queries ] }
+        if summary:
+            payload['summary'] = summary
+        response = self.session.post(f'{self.url}:{self.port}/data/samplearrays', json=payload,
+                                     headers={'Accept': BINARY_MIMETYPE})
+        response.raise_for_status()
+
+        columns, metadata = decode_binary(response.content)
+        offsets = columns['offsets']
+        return [ columns['values'][offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1) ]
 
     def get_segment_ids(self, structureID):
         return self._request(f'data/structure/{structureID}/segmentids')
 
     def get_dataset_ids(self):
         return self._request('datasets')
+
+    def get_arrays_for_all_datasets(self, arrayID):
+        # an array's slices are in the order of the dataset IDs
+        ids = sorted(self.get_dataset_ids())
+        return dict(zip(ids, self.map(lambda s: self.get_array_numpy(arrayID, s), range(len(ids)))))
+
+    def get_structures(self, structureIDs):
+        structureIDs = list(structureIDs)
+        return dict(zip(structureIDs, self.map(self.get_structure_numpy, structureIDs)))
+
+    def get_contactmaps(self, cmIDs):
+        cmIDs = list(cmIDs)
+        return dict(zip(cmIDs, self.map(self.get_contactmap_numpy, cmIDs)))
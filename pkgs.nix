@@ -33,7 +33,7 @@ let
   # Python dependencies
   pydeps = { python3 }: with python3.pkgs; [
     (pkgs.callPackage pybbi {inherit python3;})
-    flask flask-restful sqlalchemy pandas requests
+    flask flask-restful sqlalchemy pandas requests scipy
   ];
 
   # Python environment
@@ -6,13 +6,36 @@ from os import path, chdir
 import numpy
 import re
 import math
+import copy
+import threading
+import time
+import random
+import cProfile
+import heapq
+import contextlib
+import gzip
+import shutil
+import tempfile
+import zlib
+import base64
+import hashlib
+from datetime import datetime, timezone
+from collections import OrderedDict
 
 from math import nan
 
-from flask import Flask, request, jsonify, render_template, send_file, url_for, send_from_directory
+from flask import Flask, request, render_template, send_file, url_for, send_from_directory, abort, g, has_request_context
+from flask import stream_with_context
+from flask import jsonify as flask_jsonify
 from flask_restful import Resource, Api
+from werkzeug.exceptions import HTTPException
 from sqlalchemy import create_engine
 import json
+import struct
+import sqlite3
+from urllib.request import pathname2url
+from sqlalchemy.pool import QueuePool, NullPool
+from scipy.spatial import cKDTree
 
 #
 # A Flask Server that handles queries for data in a GTK project
@@ -40,47 +63,503 @@ DB_PATH = path.abspath(
     path.join( PROJECT_HOME, 'generated', 'generated-project.db')
 )
 
+# the version of the database layout this server reads
+# (written to PRAGMA user_version by bin/db_pop)
+DB_SCHEMA_VERSION = 3
+
 app = Flask(__name__)
 api = Api(app)
 
+#
+# refuse to serve a database built by an older (or newer) bin/db_pop,
+# since its tables may lack the indexes and columns the queries rely on
+#
+def check_schema_version():
+    if not path.isfile(DB_PATH):
+        return
+
+    conn    = db_connect.connect()
+    version = conn.execute("PRAGMA user_version").scalar()
+    conn.close()
+
+    if (version != DB_SCHEMA_VERSION):
+        raise RuntimeError(
+            "database {} has schema version {}, but this server requires version {}; "
+            "rebuild it with bin/db_pop".format(DB_PATH, version, DB_SCHEMA_VERSION)
+        )
+
+#
+# database connections
+#
+# Requests read the database through a pool of sqlite3 connections (of
+# GTK_DB_POOL, default 8, per worker) opened read-only, with up to
+# GTK_DB_MMAP_MB (default 256) of the file memory-mapped and a page cache
+# of GTK_DB_CACHE_MB (default 64) each. The queries are parameterised, so
+# each connection keeps their prepared statements. If GTK_READONLY is
+# set, the database is also opened immutable, so SQLite skips its file
+# locks entirely, and /data/setarray is refused.
+#
+# The only writes (from /data/setarray) go through a separate engine.
+# When the database file is replaced or modified, the pooled connections
+# are dropped and new ones opened on the next request.
+#
+READONLY      = os.environ.get('GTK_READONLY', '') not in ['', '0', 'false']
+DB_POOL_SIZE  = int(os.environ.get('GTK_DB_POOL', 8))
+DB_MMAP_BYTES = int(os.environ.get('GTK_DB_MMAP_MB', 256)) * 1024 * 1024
+DB_CACHE_KB   = int(os.environ.get('GTK_DB_CACHE_MB', 64)) * 1024
+
+def open_readonly():
+    uri  = 'file:{}?mode=ro{}'.format(pathname2url(DB_PATH), '&immutable=1' if READONLY else '')
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+    conn.execute('PRAGMA mmap_size = {}'.format(DB_MMAP_BYTES))
+    conn.execute('PRAGMA cache_size = -{}'.format(DB_CACHE_KB))
+    conn.execute('PRAGMA query_only = 1')
+    return conn
+
+#
+# identify a version of a file, even one replaced within the same mtime tick
+#
+def get_file_stat(fname):
+    try:
+        stat = os.stat(fname)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def get_db_stat():
+    return get_file_stat(DB_PATH)
+
+def create_engines():
+    global db_connect, db_writer, db_stat
+    db_stat    = get_db_stat()
+    db_connect = create_engine('sqlite:///'+DB_PATH, creator=open_readonly,
+                               poolclass=QueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE)
+    db_writer  = create_engine('sqlite:///'+DB_PATH, poolclass=NullPool)
+
+db_stat_lock = threading.Lock()
+
+#
+# drop the pooled connections if the database has changed since they were opened
+#
+def check_db_stat():
+    global db_stat
+    stat = get_db_stat()
+    if stat != db_stat:
+        with db_stat_lock:
+            if stat != db_stat:
+                db_connect.dispose()
+                db_stat = stat
+
 # If not running as the test server, we can run connect
 # to the database now (for the test server, the connection
 # is made at the bottom of the file after DB_PATH has had
 # a chance to be overwritten by command-line arguments)
-if __file__ != '__main__':
-    db_connect = create_engine('sqlite:///'+DB_PATH)
+if __name__ != '__main__':
+    create_engines()
+    check_schema_version()
+
+#
+# request instrumentation
+#
+# Off unless the GTK_INSTRUMENT environment variable is set. When on, each
+# request records the time it spends in each phase (db, io, decode, bbi,
+# index, serialize), the rows it reads and its cache hits and misses. These are
+# returned in a Server-Timing header, and accumulated per route for the
+# /metrics endpoint (in Prometheus text format, per worker).
+#
+# If GTK_PROFILE_DIR is also set, a sample of the requests (the fraction
+# GTK_PROFILE_SAMPLE, default 0.1) is run under cProfile, and the profiles
+# of the slowest GTK_PROFILE_KEEP (default 10) are kept in that directory.
+#
+INSTRUMENT     = os.environ.get('GTK_INSTRUMENT', '') not in ['', '0', 'false']
+PROFILE_DIR    = os.environ.get('GTK_PROFILE_DIR')
+PROFILE_SAMPLE = float(os.environ.get('GTK_PROFILE_SAMPLE', 0.1))
+PROFILE_KEEP   = int(os.environ.get('GTK_PROFILE_KEEP', 10))
+
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+#
+# time a phase of the current request
+#
+@contextlib.contextmanager
+def timed(phase):
+    if not (INSTRUMENT and has_request_context()):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('gtk_timings', {})
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+#
+# add to a counter of the current request
+#
+def count(name, n=1):
+    if INSTRUMENT and has_request_context():
+        counts = g.setdefault('gtk_counts', {})
+        counts[name] = counts.get(name, 0) + n
+
+def jsonify(*args, **kwargs):
+    with timed('serialize'):
+        return flask_jsonify(*args, **kwargs)
+
+#
+# per-route totals, for /metrics
+#
+class Metrics:
+
+    def __init__(self):
+        self.requests  = {}
+        self.durations = {}
+        self.phases    = {}
+        self.counts    = {}
+        self._lock     = threading.Lock()
+
+    def record(self, route, method, status, duration, nbytes, timings, counts):
+        with self._lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.durations.setdefault(route, [[0]*len(DURATION_BUCKETS), 0, 0.0])
+            for (i, bound) in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += duration
+
+            for (phase, seconds) in timings.items():
+                self.phases[(route, phase)] = self.phases.get((route, phase), 0.0) + seconds
+            counts = dict(counts, response_bytes=nbytes)
+            for (name, n) in counts.items():
+                self.counts[(route, name)] = self.counts.get((route, name), 0) + n
+
+    def render(self, caches):
+        def labels(**kwargs):
+            return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for (k, v) in kwargs.items())
+
+        lines = []
+        with self._lock:
+            lines.append('# TYPE gtk_requests_total counter')
+            for ((route, method, status), n) in sorted(self.requests.items()):
+                lines.append('gtk_requests_total{{{}}} {}'.format(labels(route=route, method=method, status=status), n))
+
+            lines.append('# TYPE gtk_request_duration_seconds histogram')
+            for (route, (buckets, n, total)) in sorted(self.durations.items()):
+                for (bound, b) in zip(DURATION_BUCKETS, buckets):
+                    lines.append('gtk_request_duration_seconds_bucket{{{}}} {}'.format(labels(route=route, le=bound), b))
+                lines.append('gtk_request_duration_seconds_bucket{{{}}} {}'.format(labels(route=route, le='+Inf'), n))
+                lines.append('gtk_request_duration_seconds_sum{{{}}} {}'.format(labels(route=route), total))
+                lines.append('gtk_request_duration_seconds_count{{{}}} {}'.format(labels(route=route), n))
+
+            lines.append('# TYPE gtk_phase_seconds_total counter')
+            for ((route, phase), seconds) in sorted(self.phases.items()):
+                lines.append('gtk_phase_seconds_total{{{}}} {}'.format(labels(route=route, phase=phase), seconds))
+
+            lines.append('# TYPE gtk_events_total counter')
+            for ((route, name), n) in sorted(self.counts.items()):
+                lines.append('gtk_events_total{{{}}} {}'.format(labels(route=route, event=name), n))
+
+        for (name, kind) in [('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                             ('entries', 'gauge'), ('bytes', 'gauge')]:
+            metric = 'gtk_cache_{}'.format(name) + ('_total' if kind == 'counter' else '')
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for stats in caches:
+                lines.append('{}{{{}}} {}'.format(metric, labels(cache=stats['name']), stats[name]))
+
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+#
+# keep the profiles of the slowest requests
+#
+profile_lock    = threading.Lock()
+slowest_lock    = threading.Lock()
+slowest_entries = []
+
+def keep_profile(profile, duration, route):
+    with slowest_lock:
+        if (len(slowest_entries) >= PROFILE_KEEP) and (duration <= slowest_entries[0][0]):
+            return
+
+        name  = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        fname = path.join(PROFILE_DIR, '{:010.3f}ms-{}-{}-{}.prof'.format(
+                    duration*1000.0, name, os.getpid(), time.time_ns()))
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile.dump_stats(fname)
+
+        heapq.heappush(slowest_entries, (duration, fname))
+        while len(slowest_entries) > PROFILE_KEEP:
+            (_, dropped) = heapq.heappop(slowest_entries)
+            if path.isfile(dropped):
+                os.remove(dropped)
+
+@app.before_request
+def start_instrumentation():
+    if not INSTRUMENT:
+        return
+
+    g.gtk_start = time.perf_counter()
+    # cProfile can only profile one request at a time
+    if (PROFILE_DIR != None) and (random.random() < PROFILE_SAMPLE) and profile_lock.acquire(blocking=False):
+        g.gtk_profile = cProfile.Profile()
+        g.gtk_profile.enable()
+
+@app.after_request
+def finish_instrumentation(response):
+    if (not INSTRUMENT) or ('gtk_start' not in g):
+        return response
+
+    start    = g.gtk_start
+    profile  = g.pop('gtk_profile', None)
+    route    = request.url_rule.rule if request.url_rule != None else 'unmatched'
+    method   = request.method
+    timings  = g.setdefault('gtk_timings', {})
+    counts   = g.setdefault('gtk_counts', {})
+
+    def finish(nbytes):
+        if profile != None:
+            profile.disable()
+            profile_lock.release()
+
+        duration = time.perf_counter() - start
+        metrics.record(route, method, response.status_code, duration, nbytes, timings, counts)
+        if profile != None:
+            keep_profile(profile, duration, route)
+        return duration
+
+    # a streamed response reads and encodes its data as it is sent, so it
+    # is recorded once it has been sent (its chunks add to the timings and
+    # counts as they go); its Server-Timing header can only cover the time
+    # up to here
+    streamed = g.get('gtk_streamed', False)
+    duration = (time.perf_counter() - start) if streamed else finish(response.content_length or 0)
+
+    entries  = ['{};dur={:.3f}'.format(phase, seconds*1000.0) for (phase, seconds) in timings.items()]
+    entries += ['{};desc="{}"'.format(name, n) for (name, n) in counts.items()]
+    entries.append('total;dur={:.3f}'.format(duration*1000.0))
+    response.headers['Server-Timing'] = ', '.join(entries)
+
+    if streamed:
+        response.call_on_close(lambda: finish(counts.pop('response_bytes', 0)))
+
+    return response
+
+#
+# A bounded, least-recently-used cache
+#
+# Entries are evicted once the total size of the cached values exceeds
+# max_bytes, or the number of entries exceeds max_entries. Every gunicorn
+# worker holds its own instance, so the limits apply per worker.
+#
+class LRUCache:
+
+    def __init__(self, name, max_bytes, max_entries):
+        self.name        = name
+        self.max_bytes   = max_bytes
+        self.max_entries = max_entries
+        self.nbytes      = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self._entries    = OrderedDict()
+        self._lock       = threading.Lock()
+
+    # an entry for which valid(value) is false is stale: it is dropped,
+    # and counted as a miss
+    def get(self, key, valid=None):
+        with self._lock:
+            if key in self._entries:
+                value = self._entries[key][0]
+                if (valid is None) or valid(value):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    count(self.name + '_cache_hits')
+                    return value
+                self.nbytes -= self._entries.pop(key)[1]
+
+            self.misses += 1
+            count(self.name + '_cache_misses')
+            return None
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+
+            # values larger than the whole budget are never cached
+            if nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while (self.nbytes > self.max_bytes) or (len(self._entries) > self.max_entries):
+                (_, (_, evicted)) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    # remove every entry whose key satisfies the predicate
+    def invalidate(self, predicate):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self.nbytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name'       : self.name,
+                'pid'        : os.getpid(),
+                'entries'    : len(self._entries),
+                'bytes'      : self.nbytes,
+                'max_bytes'  : self.max_bytes,
+                'max_entries': self.max_entries,
+                'hits'       : self.hits,
+                'misses'     : self.misses,
+                'evictions'  : self.evictions
+            }
+
+#
+# cache of parsed array metadata and decompressed array data,
+# sized with the GTK_ARRAY_CACHE_MB and GTK_ARRAY_CACHE_ENTRIES
+# environment variables
+#
+array_cache = LRUCache(
+    'array',
+    int(os.environ.get('GTK_ARRAY_CACHE_MB', 256)) * 1024 * 1024,
+    int(os.environ.get('GTK_ARRAY_CACHE_ENTRIES', 1024))
+)
+
+#
+# the database connection for the current request
+#
+# It is taken from the pool on first use and returned when the request
+# (including a /batch request and all of its queries) is finished.
+#
+def get_db():
+    if 'gtk_db' not in g:
+        check_db_stat()
+        g.gtk_db = db_connect.connect()
+    return g.gtk_db
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('gtk_db', None)
+    if conn != None:
+        conn.close()
+
+#
+# the project model
+#
+# project.json is parsed once per worker into a ProjectModel, which holds
+# the parsed file and the lookups the routes need. When the file changes
+# a new model is built and replaces the old one in a single assignment;
+# models are never modified, and each request keeps the model it started
+# with, so it sees one version of the project throughout.
+#
+class ProjectModel:
+
+    def __init__(self, fname, stat, data):
+        self.fname       = fname
+        self.stat        = stat
+        self.data        = data
+
+        items = data.get("data", {})
+        self.interval    = data.get("project", {}).get("interval")
+        self.datasets    = { d['id']: d for d in data.get("datasets", []) }
+        self.dataset_ids = sorted(d['id'] for d in data.get("datasets", []))
+        self.structures  = { s['id']: s for s in items.get("structure", []) }
+        self.contactmaps = { c['id']: c for c in items.get("md-contact-map", []) }
+        self.arrays      = { a['id']: a for a in items.get("array", []) }
+
+project_model = None
+project_lock  = threading.Lock()
+
+#
+# the current model, reloaded if project.json has changed
+#
+def load_project():
+    global project_model
+    stat  = get_file_stat(PROJECT_FILE)
+    model = project_model
+    if (model is None) or (model.fname != PROJECT_FILE) or (model.stat != stat):
+        with project_lock:
+            model = project_model
+            if (model is None) or (model.fname != PROJECT_FILE) or (model.stat != stat):
+                # the file is read after its stat is taken, so a change
+                # made while reading is picked up by the next request
+                with timed('io'):
+                    with open(PROJECT_FILE, 'r', encoding="utf-8" ) as pfile:
+                        data = json.load(pfile)
+                model = ProjectModel(PROJECT_FILE, stat, data)
+                project_model = model
+
+    return model
+
+#
+# the project model for the current request
+#
+def get_project():
+    if 'gtk_project' not in g:
+        g.gtk_project = load_project()
+    return g.gtk_project
 
 #
 # get the interval of the datasets for this project
 # TODO: generalize the storage and retrieval of this data
 #
 def get_dataset_interval():
-    interval = 0
-    with open(PROJECT_FILE, 'r', encoding="utf-8" ) as pfile:
-        data = json.load(pfile)
-
-        interval = data["project"]["interval"]
-
-    return interval
+    return get_project().interval
 
 def get_dataset_ids():
-    datasets = []
-    with open(PROJECT_FILE, 'r', encoding="utf-8" ) as pfile:
-        data = json.load(pfile)
+    return list(get_project().dataset_ids)
 
-        for d in data["datasets"]:
-            datasets.append(d['id'])
-    datasets.sort()
+#
+# the interval of the structure of the dataset at a position in the
+# dataset IDs (the slice of an array that holds its values)
+#
+def get_slice_interval(arraySlice):
+    project = get_project()
+    try:
+        dataset   = project.datasets[project.dataset_ids[int(arraySlice)]]
+        structure = project.structures[dataset['structure']['id']]
+    except (IndexError, KeyError, TypeError):
+        return project.interval
+    return structure.get('interval', project.interval)
 
-    return datasets
 
+#
+# return the modification time of a file, or None if it does not exist
+#
+def get_mtime(fname):
+    try:
+        return os.stat(fname).st_mtime_ns
+    except OSError:
+        return None
 
+#
+# get the metadata for an array
+#
+# The parsed metadata is cached, keyed by the array ID, and is reused
+# as long as neither the database nor the array's json file has been
+# modified since. Callers receive a copy they are free to modify.
+#
 def get_array_metadata(arrayID):
-    conn  = db_connect.connect()
+    key    = ('metadata', int(arrayID))
+    cached = array_cache.get(key, lambda c: c['mtime'] == (get_mtime(DB_PATH), get_mtime(c['fname'])))
+    if (cached != None):
+        return copy.deepcopy(cached['array'])
+
+    conn  = get_db()
     data  = []
 
-    query = conn.execute("SELECT url FROM array WHERE id == {}".format(arrayID))
-    results = query.cursor.fetchall()
+    with timed('db'):
+        query = conn.execute("SELECT url FROM array WHERE id == ?", [arrayID])
+        results = query.cursor.fetchall()
 
     array = {
                 "name"      : None, 
@@ -99,11 +578,110 @@ def get_array_metadata(arrayID):
     if (len(results) != 0):
         fname = PROJECT_HOME + "/" + results[0][0]
 
-        with open(fname, "r", encoding="utf-8" ) as jfile:
-            array = json.load(jfile)
+        mtime = (get_mtime(DB_PATH), get_mtime(fname))
+        with timed('io'):
+            with open(fname, "r", encoding="utf-8" ) as jfile:
+                text = jfile.read()
+        with timed('decode'):
+            array = json.loads(text)
+
+        array_cache.put(key, {'fname': fname, 'mtime': mtime, 'array': array},
+                        os.path.getsize(fname))
+        array = copy.deepcopy(array)
 
     return array
 
+#
+# open an uncompressed .npy track, memory-mapped
+#
+# The maps are shared by every request in a worker, and the pages read
+# from them are shared with the other workers through the page cache.
+# A map is reopened when its file changes.
+#
+track_maps      = {}
+track_maps_lock = threading.Lock()
+
+def open_track(fname):
+    key = (fname, get_mtime(fname))
+    with track_maps_lock:
+        if key not in track_maps:
+            for old in [k for k in track_maps if k[0] == fname]:
+                del track_maps[old]
+            track_maps[key] = numpy.load(fname, mmap_mode='r')
+
+        return track_maps[key]
+
+#
+# open a bigWig (or bigBed) file
+#
+# The handles are kept open in an LRU pool of BBI_HANDLES (GTK_BBI_HANDLES,
+# default 32) per worker, so a request does not reread the file's header
+# and index. A handle is reopened when its file changes. Reads through one
+# handle may not run at once, so each has a lock, which is held for the
+# duration of the 'with' block.
+#
+BBI_HANDLES      = int(os.environ.get('GTK_BBI_HANDLES', 32))
+bbi_handles      = OrderedDict()
+bbi_handles_lock = threading.Lock()
+
+def close_bbi(entry):
+    (handle, lock) = entry
+    with lock:
+        handle.close()
+
+@contextlib.contextmanager
+def open_bbi(fname):
+    key = (fname, get_mtime(fname))
+    with bbi_handles_lock:
+        entry = bbi_handles.get(key)
+        if entry is None:
+            for old in [k for k in bbi_handles if k[0] == fname]:
+                close_bbi(bbi_handles.pop(old))
+            with timed('io'):
+                entry = (bbi.open(fname), threading.Lock())
+            bbi_handles[key] = entry
+            while len(bbi_handles) > BBI_HANDLES:
+                close_bbi(bbi_handles.popitem(last=False)[1])
+        else:
+            bbi_handles.move_to_end(key)
+
+    (handle, lock) = entry
+    with lock:
+        if not handle.closed:
+            yield handle
+            return
+
+    # another request closed the handle in the meantime; use one of our own
+    with bbi.open(fname) as handle:
+        yield handle
+
+#
+# get the values of one slice of an array as a numpy array
+#
+# A slice stored in a .npy file is a read-only memory map: either the
+# whole (1-D) file, or the row of a 2-D datasets x segments file given
+# by the slice's 'id'. Slices stored in an .npz file are decompressed
+# and cached, keyed by the array ID, the slice and the mtime of the file.
+#
+def get_array_values(arrayID, arraySlice, info):
+    fname  = PROJECT_HOME + "/" + info['url']
+    if fname.endswith('.npy'):
+        with timed('io'):
+            track = open_track(fname)
+        return track[int(info['id'])] if track.ndim == 2 else track
+
+    key    = ('values', int(arrayID), int(arraySlice), get_mtime(fname))
+    values = array_cache.get(key)
+    if (values is None):
+        with timed('io'):
+            npz = numpy.load(fname)
+        with timed('decode'):
+            values = npz[info['id']]
+        values.setflags(write=False)
+        array_cache.put(key, values, values.nbytes)
+
+    return values
+
 #
 # get the array data for an ID
 #
@@ -114,11 +692,11 @@ def load_array_data(arrayID, arraySlice):
         # determine if there is data there
         info = array['data']['values'][int(arraySlice)]
         if (info['url'] != ""):
-            # load the data from disk
-            data = numpy.load(PROJECT_HOME + "/" + info['url'])
+            # load the data from disk (or the cache)
+            data = get_array_values(arrayID, arraySlice, info)
             values = list(map(
                 lambda d: None if math.isnan(d) else d,
-                data[info['id']].tolist()
+                data.tolist()
             ))
             array['data']['values'] = values
         # else:
@@ -126,6 +704,406 @@ def load_array_data(arrayID, arraySlice):
 
     return array
 
+#
+# conditional requests
+#
+# The data routes send a strong ETag and a Last-Modified date, derived
+# from the modification times of the database, the project file and (for
+# the array routes) the array's own files, together with the request path
+# and the format of the response. A request whose If-None-Match (or
+# If-Modified-Since) still matches gets an empty 304 response. Static
+# files are left to send_file, which validates them itself.
+#
+UNVALIDATED_ENDPOINTS = ['home', 'root', 'project', 'projectdir', 'static', 'GetMetrics', 'CacheStats']
+
+#
+# the files the answer to the current request is read from
+#
+def get_data_files():
+    files   = [DB_PATH, PROJECT_FILE]
+    arrayID = request.view_args.get('arrayID') if request.view_args else None
+    if arrayID != None:
+        try:
+            url   = get_db().execute("SELECT url FROM array WHERE id == ?", [int(arrayID)]).scalar()
+            array = get_array_metadata(arrayID)
+        except Exception:
+            # the route reports the bad ID
+            return files
+
+        if url != None:
+            files.append(PROJECT_HOME + "/" + url)
+        values = array['data'].get('values', [])
+        for v in values if isinstance(values, list) else []:
+            if v.get('url'):
+                files.append(PROJECT_HOME + "/" + v['url'])
+            if 'sequence' in v:
+                files.append(PROJECT_HOME + "/" + v['sequence']['url'])
+
+    return sorted(set(files))
+
+def get_validators():
+    mtimes = [ get_mtime(f) for f in get_data_files() ]
+    format = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE, BINARY_MIMETYPE])
+    # the streamed routes compress their answers, so they differ by encoding too
+    packed = request.accept_encodings['gzip'] > 0
+    etag   = hashlib.sha1(repr((mtimes, request.full_path, format, packed)).encode('utf-8')).hexdigest()
+
+    known    = [ m for m in mtimes if m != None ]
+    modified = datetime.fromtimestamp(max(known) // 10**9, timezone.utc) if known else None
+
+    return etag, modified
+
+def set_validators(response, etag, modified):
+    response.set_etag(etag)
+    if modified != None:
+        response.last_modified = modified
+    # caches may keep the answer, but must check that it is still current
+    response.cache_control.no_cache = True
+
+@app.before_request
+def check_validators():
+    if (request.method != 'GET') or (request.endpoint == None) or (request.endpoint in UNVALIDATED_ENDPOINTS):
+        return
+
+    (etag, modified) = get_validators()
+    g.gtk_validators = (etag, modified)
+
+    if request.if_none_match:
+        current = request.if_none_match.contains(etag)
+    else:
+        current = (request.if_modified_since != None) and (modified != None) and (modified <= request.if_modified_since)
+
+    if current:
+        response = app.response_class(status=304)
+        set_validators(response, etag, modified)
+        return response
+
+@app.after_request
+def add_validators(response):
+    if ('gtk_validators' in g) and (response.status_code == 200):
+        set_validators(response, *g.gtk_validators)
+
+    return response
+
+#
+# An in-memory index of closed [start, end] intervals
+#
+# The intervals are sorted by start, alongside the running maximum of
+# their ends. For a query range [qs, qe], every interval that overlaps it
+# lies between the first position where the running maximum reaches qs
+# and the last interval starting at or before qe, so a whole batch of
+# ranges is answered with two binary searches per range.
+#
+class IntervalIndex:
+
+    def __init__(self, starts, ends, values):
+        order       = numpy.argsort(starts, kind='stable')
+        self.starts = numpy.asarray(starts)[order]
+        self.ends   = numpy.asarray(ends)[order]
+        self.values = numpy.asarray(values)[order]
+        self.maxend = numpy.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
+        self.nbytes = self.starts.nbytes + self.ends.nbytes + self.maxend.nbytes + 64*len(self.values)
+
+    # the sorted, unique values of the intervals overlapping any of the ranges
+    def overlapping(self, qstarts, qends):
+        qstarts = numpy.asarray(qstarts, dtype=self.starts.dtype)
+        qends   = numpy.asarray(qends, dtype=self.starts.dtype)
+
+        lo     = numpy.searchsorted(self.maxend, qstarts, side='left')
+        hi     = numpy.searchsorted(self.starts, qends, side='right')
+        counts = numpy.maximum(hi - lo, 0)
+
+        # expand each range into the positions of its candidates
+        total     = int(counts.sum())
+        offsets   = numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+        positions = offsets + numpy.arange(total)
+        keep      = self.ends[positions] >= numpy.repeat(qstarts, counts)
+
+        return numpy.unique(self.values[positions[keep]]).tolist()
+
+#
+# cache of the gene and segment interval indexes; these are built once
+# per worker from the database, and rebuilt if the database changes
+#
+index_cache = LRUCache(
+    'index',
+    int(os.environ.get('GTK_INDEX_CACHE_MB', 256)) * 1024 * 1024,
+    int(os.environ.get('GTK_INDEX_CACHE_ENTRIES', 256))
+)
+
+index_lock = threading.Lock()
+
+#
+# cache of the summaries read from bigWig files (one per window, number
+# of samples and summary type), sized with GTK_BBI_CACHE_MB and
+# GTK_BBI_CACHE_ENTRIES
+#
+bbi_cache = LRUCache(
+    'bbi',
+    int(os.environ.get('GTK_BBI_CACHE_MB', 64)) * 1024 * 1024,
+    int(os.environ.get('GTK_BBI_CACHE_ENTRIES', 4096))
+)
+
+#
+# cache of whole serialised responses that are costly to build, sized
+# with GTK_RESPONSE_CACHE_MB and GTK_RESPONSE_CACHE_ENTRIES
+#
+response_cache = LRUCache(
+    'response',
+    int(os.environ.get('GTK_RESPONSE_CACHE_MB', 256)) * 1024 * 1024,
+    int(os.environ.get('GTK_RESPONSE_CACHE_ENTRIES', 256))
+)
+
+#
+# index of the genes by location, and the location of each gene by name
+#
+def get_gene_index():
+    key   = ('genes', get_mtime(DB_PATH))
+    index = index_cache.get(key)
+    if (index is None):
+        with index_lock:
+            # another request may have built it while this one waited
+            index = index_cache.get(key)
+            if (index is not None):
+                return index
+
+            with timed('db'):
+                rows = get_db().execute("SELECT start, end, gene_name FROM genes ORDER BY id").fetchall()
+
+            starts = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+            ends   = numpy.array([r[1] for r in rows], dtype=numpy.int64)
+            names  = numpy.array([r[2] for r in rows], dtype=object)
+
+            # the first gene with each name
+            locations = {}
+            for (name, start, end) in zip(names.tolist(), starts.tolist(), ends.tolist()):
+                locations.setdefault(name, (start, end))
+
+            index = {
+                'ranges'   : IntervalIndex(starts, ends, names),
+                'locations': locations
+            }
+            index_cache.put(key, index, index['ranges'].nbytes + 64*len(locations))
+
+    return index
+
+#
+# index of a structure's segments by ID and by location
+#
+def get_segment_index(structureid):
+    try:
+        structureid = int(structureid)
+    except ValueError:
+        # not a structure ID, so a structure with no segments
+        structureid = None
+
+    key   = ('segments', structureid, get_mtime(DB_PATH))
+    index = index_cache.get(key)
+    if (index is None):
+        with index_lock:
+            # another request may have built it while this one waited
+            index = index_cache.get(key)
+            if (index is not None):
+                return index
+
+            with timed('db'):
+                rows = get_db().execute("SELECT segid, startid, endid FROM structure WHERE structureid = ? ORDER BY segid",
+                                        structureid).fetchall()
+
+            rows = numpy.array(rows, dtype=numpy.int64).reshape(-1, 3)
+            index = {
+                'segid'  : rows[:, 0],
+                'startid': rows[:, 1],
+                'endid'  : rows[:, 2],
+                'ranges' : IntervalIndex(rows[:, 1], rows[:, 2], rows[:, 0])
+            }
+            index_cache.put(key, index, rows.nbytes + index['ranges'].nbytes)
+
+    return index
+
+#
+# parse a comma-separated list of IDs or ID ranges ('1,4,6-9')
+# returns a list of (start, end) pairs; single IDs have start == end
+#
+def parse_ranges(text):
+    ranges = []
+    for s in re.sub(r'\s', '', text).split(','):
+        match = re.match( r'^(?P<start>[0-9]+)(\-(?P<end>[0-9]+))?$', s )
+        if (match != None):
+            end = match.group('end') if match.group('end') != None else match.group('start')
+            ranges.append((int(match.group('start')), int(end)))
+
+    return ranges
+
+#
+# binary responses
+#
+# Routes that return large numeric tables can also answer with raw
+# buffers instead of JSON, when the request has ?format=npy or prefers
+# 'application/octet-stream' in its Accept header. The payload is:
+#
+#   4 bytes     the magic string 'GTKB'
+#   4 bytes     length of the header (little-endian uint32)
+#   header      utf-8 JSON, padded with spaces to a multiple of 8 bytes
+#   buffers     the raw little-endian data of each column
+#
+# The header lists each column's name, dtype, shape and the offset of its
+# data, counted from the end of the header. Offsets are multiples of 8,
+# so the columns can be wrapped without copying (numpy.frombuffer, or a
+# typed array in Javascript). Missing values are kept as NaN.
+#
+BINARY_MIMETYPE = 'application/octet-stream'
+BINARY_MAGIC    = b'GTKB'
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+#
+# determine the format a request asks for: 'json', 'ndjson' or 'npy'
+#
+def response_format():
+    fmt = request.args.get('format')
+    if (fmt != None):
+        if fmt not in ['json', 'ndjson', 'npy']:
+            abort(400, "unknown format: {}".format(fmt))
+        return fmt
+
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE, BINARY_MIMETYPE])
+    if (best == BINARY_MIMETYPE):
+        return 'npy'
+    elif (best == NDJSON_MIMETYPE):
+        return 'ndjson'
+    return 'json'
+
+def wants_binary():
+    return (response_format() == 'npy')
+
+#
+# pack a list of (name, numpy array) columns into a binary payload
+#
+def pack_binary(columns, metadata={}):
+    with timed('serialize'):
+        return pack_columns(columns, metadata)
+
+def pack_columns(columns, metadata):
+    header  = {'columns': [], 'metadata': metadata}
+    buffers = []
+    offset  = 0
+    for (name, data) in columns:
+        data = numpy.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))
+        header['columns'].append({
+            'name'  : name,
+            'dtype' : data.dtype.str,
+            'shape' : list(data.shape),
+            'offset': offset
+        })
+        buffers.append(data.tobytes())
+        padding = -len(buffers[-1]) % 8
+        buffers.append(b'\0' * padding)
+        offset += len(buffers[-2]) + padding
+
+    hbytes  = json.dumps(header).encode('utf-8')
+    hbytes += b' ' * (-len(hbytes) % 8)
+
+    return b''.join([BINARY_MAGIC, struct.pack('<I', len(hbytes)), hbytes] + buffers)
+
+def binary_response(columns, metadata={}):
+    return app.response_class(pack_binary(columns, metadata), mimetype=BINARY_MIMETYPE)
+
+#
+# streamed responses
+#
+# The routes that can return very large lists (contact maps, genes and
+# segments) write them as they are read: rows come from the database
+# STREAM_ROWS (GTK_STREAM_ROWS, default 10000) at a time, and each batch
+# is sent as one chunk of the JSON document, so a worker holds one batch
+# rather than the whole answer. With ?format=ndjson (or an Accept header
+# of application/x-ndjson) each record is written on a line of its own
+# instead. The chunks are gzip-compressed as they go when the client
+# accepts it (GTK_STREAM_GZIP_LEVEL, default 6; 0 turns this off).
+#
+# A streamed response has no Content-Length. Its reads and encoding are
+# instrumented as its chunks are made, and it is added to /metrics once
+# the last one is sent; its Server-Timing header, sent before the first
+# chunk, does not include them.
+#
+STREAM_ROWS       = int(os.environ.get('GTK_STREAM_ROWS', 10000))
+STREAM_GZIP_LEVEL = int(os.environ.get('GTK_STREAM_GZIP_LEVEL', 6))
+
+#
+# read the rows of a query in batches
+#
+def fetch_batches(query, params=[]):
+    with timed('db'):
+        result = get_db().execute(query, params)
+    try:
+        while True:
+            with timed('db'):
+                rows = result.fetchmany(STREAM_ROWS)
+            if not rows:
+                break
+            count('rows', len(rows))
+            yield rows
+    finally:
+        result.close()
+
+#
+# encode batches of records as the chunks of {"<name>": [...]} (in the
+# same compact, key-sorted form as jsonify), or as lines of NDJSON
+#
+def json_chunks(name, batches, fmt):
+    def dumps(value):
+        with timed('serialize'):
+            return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+    if (fmt == 'ndjson'):
+        for records in batches:
+            if records:
+                yield ''.join(dumps(r) + '\n' for r in records).encode('utf-8')
+        return
+
+    yield '{{{}:['.format(dumps(name)).encode('utf-8')
+    separator = ''
+    for records in batches:
+        if records:
+            # the records of a batch, without the surrounding brackets
+            yield (separator + dumps(records)[1:-1]).encode('utf-8')
+            separator = ','
+    yield b']}\n'
+
+#
+# compress chunks as they are sent; each is flushed so the client can
+# decode it as soon as it arrives
+#
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(STREAM_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        with timed('serialize'):
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield chunk
+    yield compressor.flush()
+
+def wants_gzip():
+    return (STREAM_GZIP_LEVEL > 0) and (request.accept_encodings['gzip'] > 0)
+
+#
+# count the bytes of the chunks as they are sent
+#
+def counted_chunks(chunks):
+    for chunk in chunks:
+        count('response_bytes', len(chunk))
+        yield chunk
+
+def stream_response(chunks, fmt):
+    mimetype = NDJSON_MIMETYPE if (fmt == 'ndjson') else 'application/json'
+    headers  = { 'Vary': 'Accept-Encoding' }
+    if wants_gzip():
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    if INSTRUMENT:
+        g.gtk_streamed = True
+        chunks = counted_chunks(chunks)
+    return app.response_class(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
 #
 # routes for serving static files
 #
@@ -150,9 +1128,9 @@ def projectdir(path):
 #
 @app.route('/data/arrays/<atype>')
 def GetArrays(atype):
-    conn  = db_connect.connect()
+    conn  = get_db()
     data  = []
-    query = conn.execute("SELECT name,id,type,min,max FROM array WHERE type == \'{}\' ORDER BY id".format(atype))
+    query = conn.execute("SELECT name,id,type,min,max FROM array WHERE type == ? ORDER BY id", [atype])
     for a in query.cursor.fetchall():
         element = { 
                     'name': a[0],
@@ -174,6 +1152,21 @@ def GetArrays(atype):
 
     return jsonify({ 'arrays': data })
 
+#
+# report the state of this worker's caches
+#
+@app.route('/metrics')
+def GetMetrics():
+    if not INSTRUMENT:
+        abort(404, "instrumentation is off; set GTK_INSTRUMENT to enable it")
+
+    text = metrics.render([array_cache.stats(), index_cache.stats(), response_cache.stats(), bbi_cache.stats()])
+    return app.response_class(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats')
+def CacheStats():
+    return jsonify({ 'caches': [array_cache.stats(), index_cache.stats(), response_cache.stats(), bbi_cache.stats()] })
+
 #
 # return a list of the project IDs
 #
@@ -186,6 +1179,22 @@ def GetDatasetIDs():
 #
 @app.route('/data/array/<arrayID>/<arraySlice>')
 def GetArray(arrayID, arraySlice):
+    if wants_binary():
+        array  = get_array_metadata(arrayID)
+        values = numpy.zeros(0, dtype=numpy.float32)
+        if (array['type'] != None):
+            info = array['data']['values'][int(arraySlice)]
+            if (info['url'] != ""):
+                values = get_array_values(arrayID, arraySlice, info)
+                if numpy.issubdtype(values.dtype, numpy.integer):
+                    values = values.astype(numpy.int32)
+                else:
+                    values = values.astype(numpy.float32)
+
+        # everything but the values themselves goes into the header
+        del array['data']['values']
+        return binary_response([('values', values)], array)
+
     array = load_array_data(arrayID, arraySlice)
 
     return jsonify(array)
@@ -193,60 +1202,169 @@ def GetArray(arrayID, arraySlice):
 #
 # set a data array
 #
+# The values can be sent as
+#
+#   - JSON, with the metadata and the values (as a list, in "array")
+#   - an .npy file (Content-Type: application/octet-stream), with the
+#     metadata in the query string
+#   - multipart/form-data, with the metadata as form fields and an .npy
+#     file for each dataset, named by the dataset's ID, or a single one
+#     named "values" that all datasets share
+#
+# Uploaded files are copied to disk as they arrive, and each distinct
+# array is stored once. The array's ID is allocated by the database when
+# the array is registered, in the same transaction that moves its files
+# into place, so concurrent uploads (from any worker) never share an ID.
+#
+UPLOAD_CHUNK = 1024 * 1024
+
+#
+# the metadata of an upload, from its JSON document or form fields
+#
+def upload_metadata(fields, tags):
+    if not fields.get("name"):
+        abort(400, "an array needs a name")
+    try:
+        datadim = int(fields.get("datadim", 1))
+    except (TypeError, ValueError):
+        abort(400, "datadim must be an integer")
+
+    return {
+        "name"    : fields["name"],
+        "type"    : fields.get("type", "structure"),
+        "tags"    : tags,
+        "datatype": fields.get("datatype", "float"),
+        "datadim" : datadim
+    }
+
+#
+# check that a file holds a complete 1-D array of numbers, in .npy format
+#
+def check_npy(fname):
+    with open(fname, 'rb') as afile:
+        try:
+            version = numpy.lib.format.read_magic(afile)
+            if (version == (1, 0)):
+                (shape, fortran, dtype) = numpy.lib.format.read_array_header_1_0(afile)
+            elif (version == (2, 0)):
+                (shape, fortran, dtype) = numpy.lib.format.read_array_header_2_0(afile)
+            else:
+                abort(400, "unsupported .npy version: {}".format(version))
+        except ValueError as error:
+            abort(400, "not an .npy file: {}".format(error))
+        offset = afile.tell()
+
+    if (len(shape) != 1) or (dtype.kind not in 'iuf'):
+        abort(400, "expected a 1-D array of numbers, not {} {}".format(dtype, shape))
+    if (offset + shape[0] * dtype.itemsize != os.path.getsize(fname)):
+        abort(400, "the .npy file is incomplete")
+
+#
+# the smallest and largest (finite) values of some arrays
+#
+def values_range(fnames):
+    (low, high) = (None, None)
+    for fname in fnames:
+        values = numpy.load(fname, mmap_mode='r')
+        values = values[numpy.isfinite(values)] if (values.dtype.kind == 'f') else values
+        if len(values):
+            low  = values.min().item() if low  is None else min(low,  values.min().item())
+            high = values.max().item() if high is None else max(high, values.max().item())
+
+    return low, high
+
 @app.route('/data/setarray', methods=['POST'])
 def SetArray():
-    results = {}
-    if (request.method == "POST"):
-        # get the next IR
-        conn  = db_connect.connect()
-        query = conn.execute("SELECT COUNT(*) FROM array")
-        results = query.cursor.fetchall()
-        arrayID = results[0][0]
-        fid         = '{:04d}'.format(arrayID)
-        fname       = 'source/array/{}.json'.format(fid) 
-        fullname    = '{}/{}'.format(PROJECT_HOME, fname)
-        aname       = 'source/array/{}.npz'.format(fid) 
-        arrayfname  = '{}/{}'.format(PROJECT_HOME, aname) 
-
-        # save the file to the database
-        data = request.get_json()
-        conn.execute('''INSERT INTO array (id,name,type,url) VALUES (?,?,?,?)''', [arrayID, data["name"], data["type"], fname])
-
-        with open(fullname, 'w') as jfile:
-            jfile.write("{\n")
-            jfile.write("\"name\"      : \"{}\",\n".format(data["name"]))
-            jfile.write("\"type\"      : \"{}\",\n".format(data["type"]))
-            jfile.write("\"version\"   : \"0.1\",\n")
-            jfile.write("\"tags\"      : {},\n".format(data["tags"]))
-            jfile.write("\"data\"      : {\n")
-            jfile.write("    \"type\"  : \"{}\",\n".format(data["datatype"]))
-            jfile.write("    \"dim\"   : {},\n".format(data["datadim"]))
-            jfile.write("    \"values\" : [\n")
-            firstTime = True;
-            for d in get_dataset_ids():
-                if ( firstTime ) :
-                    firstTime = False
-                else :
-                    # finish the previous array 
-                    jfile.write("        },\n")
-                jfile.write("        {\n")
-                jfile.write("            \"id\"  : \"arr_{}\",\n".format(d))
-                jfile.write("            \"url\" : \"{}\"\n".format(aname))
-            jfile.write("        }\n")
-            jfile.write("    ]\n")
-            jfile.write("}\n")
-            jfile.write("}\n")
-
-        # TODO:
-        # for this call, we save the same array information for each dataset
-        # we must provide another call to save different arrays for each dataset 
-        kwargs = {} 
-        for d in get_dataset_ids():
-            kwargs["arr_{}".format(d)] = data["array"]
-
-        numpy.savez_compressed(arrayfname, **kwargs) 
-
-    results = {'id': arrayID}        
+    if READONLY:
+        abort(403, 'the server is read-only (GTK_READONLY is set)')
+
+    arraydir = path.join(PROJECT_HOME, 'source', 'array')
+    os.makedirs(arraydir, exist_ok=True)
+    datasets = get_dataset_ids()
+
+    # the temporary file of each upload, keyed by dataset ID (None for
+    # an array every dataset shares)
+    uploads = {}
+    def upload_file(key):
+        (fd, tmpname) = tempfile.mkstemp(suffix='.npy.tmp', dir=arraydir)
+        uploads[key] = tmpname
+        return os.fdopen(fd, 'wb')
+
+    try:
+        if (request.mimetype == BINARY_MIMETYPE):
+            metadata = upload_metadata(request.args, request.args.getlist("tags"))
+            with upload_file(None) as afile:
+                shutil.copyfileobj(request.stream, afile, UPLOAD_CHUNK)
+
+        elif (request.mimetype == 'multipart/form-data'):
+            metadata = upload_metadata(request.form, request.form.getlist("tags"))
+            names    = set(request.files.keys())
+            if (names == {"values"}):
+                keys = { "values": None }
+            else:
+                keys = { str(d): d for d in datasets }
+                if (names != set(keys)):
+                    abort(400, "expected an array named 'values', or one for each dataset ({})".format(", ".join(keys)))
+            for (name, key) in keys.items():
+                with upload_file(key) as afile:
+                    request.files[name].save(afile, UPLOAD_CHUNK)
+
+        else:
+            data = request.get_json(silent=True)
+            if (not isinstance(data, dict)) or ("array" not in data):
+                abort(400, "expected a JSON object with the array's metadata and \"array\"")
+            metadata = upload_metadata(data, data.get("tags", []))
+            values = numpy.asarray(data["array"])
+            if values.dtype == object:
+                # missing values (None) become NaN
+                values = numpy.array(data["array"], dtype=numpy.float64)
+            with upload_file(None) as afile:
+                numpy.save(afile, values)
+
+        for tmpname in uploads.values():
+            check_npy(tmpname)
+        (low, high) = values_range(uploads.values())
+
+        # register the array, and move its files into place (each in one
+        # step, so open maps of an older file stay valid)
+        with db_writer.begin() as conn:
+            arrayID = conn.execute("INSERT INTO array (name, type, min, max) VALUES (?, ?, ?, ?)",
+                                   [metadata["name"], metadata["type"], low, high]).lastrowid
+            fid     = '{:04d}'.format(arrayID)
+            fname   = 'source/array/{}.json'.format(fid)
+            conn.execute("UPDATE array SET url = ? WHERE id == ?", [fname, arrayID])
+
+            urls = {}
+            for (key, tmpname) in uploads.items():
+                urls[key] = 'source/array/{}.npy'.format(fid) if key is None else 'source/array/{}.{}.npy'.format(fid, key)
+                os.replace(tmpname, path.join(PROJECT_HOME, urls[key]))
+
+            array = {
+                "name"      : metadata["name"],
+                "type"      : metadata["type"],
+                "version"   : "0.1",
+                "tags"      : metadata["tags"],
+                "data"      : {
+                    "type"  : metadata["datatype"],
+                    "dim"   : metadata["datadim"],
+                    "min"   : low,
+                    "max"   : high,
+                    "values": [ { "id": "arr_{}".format(d), "url": urls.get(None, urls.get(d)) } for d in datasets ]
+                }
+            }
+            fullname = path.join(PROJECT_HOME, fname)
+            with open(fullname + '.tmp', 'w') as jfile:
+                json.dump(array, jfile, indent=4)
+            os.replace(fullname + '.tmp', fullname)
+    finally:
+        for tmpname in uploads.values():
+            if path.exists(tmpname):
+                os.remove(tmpname)
+
+    # drop anything cached under this ID
+    array_cache.invalidate(lambda k: k[1] == arrayID)
+
+    results = {'id': arrayID}
     return jsonify(results)
 
 #
@@ -254,8 +1372,8 @@ def SetArray():
 #
 @app.route('/data/structure/<identifier>/unmapped')
 def UnmappedData(identifier):
-    conn    = db_connect.connect()
-    query   = conn.execute("SELECT num_segments,unmapped FROM structure_metadata WHERE id == {}".format(identifier))
+    conn    = get_db()
+    query   = conn.execute("SELECT num_segments,unmapped FROM structure_metadata WHERE id == ?", [identifier])
     results = query.cursor.fetchone()
 
     print("results: {}".format(results))
@@ -289,36 +1407,92 @@ def UnmappedData(identifier):
     return jsonify({ 'unmapped': list(final) })
 
 
+#
+# the segments of a structure, as (name, numpy array) columns sorted by
+# segment ID, wrapping the buffers bin/db_pop stored in structure_geometry:
+# int32 IDs and lengths (int64 if they don't fit), and Nx3 float32
+# coordinates
+#
+GEOMETRY_COLUMNS = [('segid', 'i', 1), ('startid', 'i', 1), ('endid', 'i', 1), ('length', 'i', 1),
+                    ('start', 'f', 3), ('end', 'f', 3), ('center', 'f', 3)]
+
+def get_structure_geometry(identifier):
+    names = ", ".join(name for (name, kind, width) in GEOMETRY_COLUMNS)
+    with timed('db'):
+        row = get_db().execute("SELECT num_segments, {} FROM structure_geometry WHERE id == ?".format(names),
+                               [identifier]).fetchone()
+
+    numsegs = row[0] if row != None else 0
+    columns = []
+    for (i, (name, kind, width)) in enumerate(GEOMETRY_COLUMNS):
+        if numsegs == 0:
+            data = numpy.zeros(0, dtype='<{}4'.format(kind))
+        else:
+            data = numpy.frombuffer(row[i + 1], dtype='<{}{}'.format(kind, len(row[i + 1]) // (numsegs * width)))
+        columns.append((name, data.reshape(-1, 3) if width == 3 else data))
+    count('rows', numsegs)
+
+    return columns
+
 #
 # return the segments of a structure
 #
+# The binary response is built from the stored buffers, and the JSON
+# response is streamed from the structure table; both are cached once built
+#
 @app.route('/data/structure/<identifier>/segments')
 def SegmentData(identifier):
-    conn    = db_connect.connect()
-    query   = conn.execute("SELECT segid, startid, endid, length, startx, starty, startz, endx, endy, endz FROM structure WHERE structureid == {} ORDER BY segid".format(identifier))
-    data    = []
-    lengths = []
-    for b in query.cursor.fetchall():
-        data.append({ 
+    fmt  = response_format()
+    key  = ('segments', identifier, fmt, get_mtime(DB_PATH))
+    body = response_cache.get(key)
+
+    if (fmt == 'npy'):
+        if (body is None):
+            body = pack_binary(get_structure_geometry(identifier))
+            response_cache.put(key, body, len(body))
+        return app.response_class(body, mimetype=BINARY_MIMETYPE)
+
+    if (body is None):
+        # the JSON form keeps the full (float64) coordinates
+        query   = "SELECT segid, startid, endid, length, startx, starty, startz, endx, endy, endz FROM structure WHERE structureid == ? ORDER BY segid"
+        batches = ( [ {
                         'segid'  : int(b[0]),
                         'startid': int(b[1]),
                         'endid'  : int(b[2]),
                         'length' : int(b[3]),
                         'start'  : [float(b[4]), float(b[5]), float(b[6])],
                         'end'    : [float(b[7]), float(b[8]), float(b[9])],
-                    })
+                      } for b in rows ] for rows in fetch_batches(query, [identifier]) )
+        chunks = cache_chunks(key, json_chunks('segments', batches, fmt))
+    else:
+        chunks = iter([ body ])
+
+    return stream_response(chunks, fmt)
+
+#
+# pass chunks through, and cache the whole body once the last one is sent
+#
+def cache_chunks(key, chunks):
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
 
-    return jsonify({ 'segments': data })
+    body = b''.join(parts)
+    response_cache.put(key, body, len(body))
 
 #
 # return the segments of a structure
 #
 @app.route('/data/structure/<identifier>/segmentids')
 def SegmentIds(identifier):
-    conn    = db_connect.connect()
-    query   = conn.execute("SELECT segid FROM structure WHERE structureid == {} ORDER BY segid".format(identifier))
+    conn    = get_db()
+    with timed('db'):
+        query   = conn.execute("SELECT segid FROM structure WHERE structureid == ? ORDER BY segid", [identifier])
+        results = query.cursor.fetchall()
+    count('rows', len(results))
     data    = []
-    for b in query.cursor.fetchall():
+    for b in results:
         data.append(b[0])
 
     return jsonify({ 'segmentids': data })
@@ -328,17 +1502,110 @@ def SegmentIds(identifier):
 #
 @app.route('/data/contact-map/<identifier>')
 def ContactMap(identifier):
-    conn    = db_connect.connect()
-    query   = conn.execute("SELECT x, y, value FROM contactmap WHERE id == ?", [identifier])
-    data    = []
-    for c in query.cursor.fetchall():
+    fmt   = response_format()
+    # records are returned in the order they appear in the source file
+    query = "SELECT x, y, value FROM contactmap WHERE id == ? ORDER BY rowid"
+
+    if (fmt == 'npy'):
+        with timed('db'):
+            results = get_db().execute(query, [identifier]).cursor.fetchall()
+        count('rows', len(results))
+
+        # missing values (NULL) become NaN
+        rows = numpy.array(results, dtype=numpy.float64).reshape(-1, 3)
+        return binary_response([
+                    ('x'    , rows[:, 0].astype(numpy.int32)),
+                    ('y'    , rows[:, 1].astype(numpy.int32)),
+                    ('value', rows[:, 2].astype(numpy.float32))
+                ])
+
+    batches = ( [ {
+                    'x': int(c[0]),
+                    'y': int(c[1]),
+                    'value': None if c[2] is None else float(c[2])
+                  } for c in rows ] for rows in fetch_batches(query, [identifier]) )
+
+    return stream_response(json_chunks('contacts', batches, fmt), fmt)
+
+#
+# contact map pyramids
+#
+# bin/db_pop stores each contact map as a pyramid of square tiles. At the
+# finest zoom level (levels - 1) a bin is a single record; each coarser
+# level halves the resolution, so zoom 0 covers the whole map in one tile.
+# Bins hold the mean of the records they contain. A tile is stored either
+# dense (tile_size x tile_size float32 values, NaN where empty) or sparse
+# (uint16 x offsets, uint16 y offsets, float32 values).
+#
+def decode_tile(data, count, dense, tile_size):
+    if dense:
+        block  = numpy.frombuffer(data, dtype='<f4').reshape(tile_size, tile_size)
+        (ly, lx) = numpy.nonzero(~numpy.isnan(block))
+        return lx, ly, block[ly, lx]
+
+    lx = numpy.frombuffer(data, dtype='<u2', count=count, offset=0)
+    ly = numpy.frombuffer(data, dtype='<u2', count=count, offset=2*count)
+    values = numpy.frombuffer(data, dtype='<f4', count=count, offset=4*count)
+    return lx, ly, values
+
+@app.route('/data/contact-map/<identifier>/tiles')
+def ContactMapTiles(identifier):
+    conn    = get_db()
+    pyramid = conn.execute("SELECT size, tile_size, levels FROM contactmap_pyramid WHERE id == ?", [identifier]).fetchone()
+    if pyramid is None:
+        return jsonify({ 'id': identifier, 'size': 0, 'tile_size': 0, 'levels': [] })
+
+    (size, tile_size, levels) = pyramid
+    counts = dict(conn.execute(
+        "SELECT zoom, COUNT(*) FROM contactmap_tile WHERE id == ? GROUP BY zoom", [identifier]
+    ).fetchall())
+
+    data = []
+    for zoom in range(levels):
         data.append({
-            'x': int(c[0]),
-            'y': int(c[1]),
-            'value': None if c[2] is None else float(c[2])
+            'zoom'     : zoom,
+            'bin_size' : 1 << (levels - 1 - zoom),
+            'tiles'    : counts.get(zoom, 0)
         })
 
-    return jsonify({ 'contacts': data })
+    return jsonify({ 'id': identifier, 'size': size, 'tile_size': tile_size, 'levels': data })
+
+@app.route('/data/contact-map/<identifier>/tile/<int:zoom>/<int:tx>/<int:ty>')
+def ContactMapTile(identifier, zoom, tx, ty):
+    conn    = get_db()
+    pyramid = conn.execute("SELECT tile_size, levels FROM contactmap_pyramid WHERE id == ?", [identifier]).fetchone()
+    if (pyramid is None) or (zoom >= pyramid[1]):
+        abort(404, "no zoom level {} for contact map {}".format(zoom, identifier))
+
+    (tile_size, levels) = pyramid
+    bin_size = 1 << (levels - 1 - zoom)
+    with timed('db'):
+        tile = conn.execute(
+            "SELECT count, dense, data FROM contactmap_tile WHERE id == ? AND zoom == ? AND tx == ? AND ty == ?",
+            [identifier, zoom, tx, ty]
+        ).fetchone()
+
+    if tile is None:
+        x = y = numpy.zeros(0, dtype=numpy.int32)
+        values = numpy.zeros(0, dtype=numpy.float32)
+    else:
+        with timed('decode'):
+            (lx, ly, values) = decode_tile(tile[2], tile[0], tile[1], tile_size)
+        count('rows', len(values))
+        # report the first record of each bin, in the coordinates of the source file
+        x = ((tx * tile_size + lx.astype(numpy.int32)) * bin_size + 1).astype(numpy.int32)
+        y = ((ty * tile_size + ly.astype(numpy.int32)) * bin_size + 1).astype(numpy.int32)
+
+    metadata = { 'zoom': zoom, 'tx': tx, 'ty': ty, 'tile_size': tile_size, 'bin_size': bin_size }
+    if wants_binary():
+        return binary_response([ ('x', x), ('y', y), ('value', values.astype(numpy.float32)) ], metadata)
+
+    data = []
+    for (cx, cy, cv) in zip(x.tolist(), y.tolist(), values.tolist()):
+        data.append({ 'x': cx, 'y': cy, 'value': cv })
+    metadata['contacts'] = data
+
+    return jsonify(metadata)
 
 #
 # get the project-wide interval
@@ -353,14 +1620,10 @@ def ProjectInterval():
 @app.route('/genes')
 def Genes():
     # return all genes
-    conn = db_connect.connect()
+    fmt     = response_format()
+    batches = ( [ g[0] for g in rows ] for rows in fetch_batches("SELECT DISTINCT gene_name from genes ORDER BY gene_name") )
 
-    query = conn.execute("SELECT DISTINCT gene_name from genes ORDER BY gene_name")
-    genes = []
-    for g in query.cursor.fetchall():
-        genes.append(g[0])
-
-    return jsonify({'genes': genes})
+    return stream_response(json_chunks('genes', batches, fmt), fmt)
 
 #
 # get metadata for a gene 
@@ -368,9 +1631,9 @@ def Genes():
 @app.route('/gene/<name>')
 def GetGeneMetadata(name):
     # return all genes
-    conn = db_connect.connect()
+    conn = get_db()
 
-    query = conn.execute("SELECT start,end,length,gene_type,gene_name from genes WHERE gene_name = ?", name)
+    query = conn.execute("SELECT start,end,length,gene_type,gene_name from genes WHERE gene_name = ?", [name])
     results = query.cursor.fetchone()
 
     # initialize
@@ -400,53 +1663,23 @@ def GetGeneMetadata(name):
 #
 @app.route('/data/structure/<structureid>/segment/<segmentids>/genes')
 def GenesForSegments(structureid, segmentids):
-    # if the query returns nothing, we return an empty list
-    genes = []
-
-    # find all genes that intersect with the segments
-    conn = db_connect.connect()
-    cleaned = re.sub(r'\s', '', segmentids)
-    sids = cleaned.split(',')
+    index  = get_segment_index(structureid)
+    ranges = numpy.array(parse_ranges(segmentids), dtype=numpy.int64).reshape(-1, 2)
 
-    for s in sids:
-        match = re.match( r'^(?P<start>[0-9]+)\-(?P<end>[0-9]+)$', s )
+    # a range of segments runs from the start of its first segment to
+    # the end of its last one, clamped to the segments that exist
+    first = numpy.searchsorted(index['segid'], ranges[:, 0], side='left')
+    last  = numpy.searchsorted(index['segid'], ranges[:, 1], side='right') - 1
+    found = (first <= last)
+    starts = index['startid'][first[found]]
+    ends   = index['endid'][last[found]]
 
-        seg_start = 0
-        seg_end   = 0
-        if (match != None):
-            # this is a range
-                # get the start
-            query   = conn.execute("SELECT startid, endid FROM structure WHERE structureid = ? AND segid = ?", structureid, match.group('start'))
-            results = query.cursor.fetchall()
-            if (len(results) != 0):
-                seg_start = results[0][0]
-
-                # get the end
-            query   = conn.execute("SELECT startid, endid FROM structure WHERE structureid = ? AND segid = ?", structureid, match.group('end'))
-            results = query.cursor.fetchall()
-
-            if (len(results) != 0):
-                seg_end = results[0][1]
-        else:
-            # find all genes that intersect with these segments 
-            query   = conn.execute("SELECT startid, endid FROM structure WHERE structureid = ? AND segid = ?", structureid, s)
-            results = query.cursor.fetchall()
+    for (s, e) in ranges[~found & (ranges[:, 0] == ranges[:, 1])].tolist():
+        print("ERROR! no segment found for: {}, {}".format(structureid, s))
 
-            # query and create a list of genes 
-            if (len(results) != 0):
-                seg_start = results[0][0]
-                seg_end   = results[0][1]
+    # find all genes that intersect with these segments
+    genes = get_gene_index()['ranges'].overlapping(starts, ends)
 
-            else:
-                print("ERROR! no segment found for: {}, {}".format(structureid, s))
-
-        # find the genes for a range 
-        results = getGenesForLocationRange( seg_start, seg_end )
-        for g in results: 
-            if (not g in genes):
-                genes.append(g)
-
-    genes.sort()
     return jsonify({'genes': genes})
 
 
@@ -455,33 +1688,11 @@ def GenesForSegments(structureid, segmentids):
 #
 @app.route('/data/structure/<structureid>/locations/<locations>/genes')
 def GenesForLocations(structureid, locations):
-    # if the query returns nothing, we return an empty list
-    genes = []
-
-    # find all genes that intersect with the segments
-    conn = db_connect.connect()
-    cleaned = re.sub(r'\s', '', locations)
-    locations = cleaned.split(',')
-
-    for s in locations:
-        match = re.match( r'^(?P<start>[0-9]+)\-(?P<end>[0-9]+)$', s )
+    ranges = numpy.array(parse_ranges(locations), dtype=numpy.int64).reshape(-1, 2)
 
-        start = 0
-        end   = 0
-        if (match != None):
-            start = match.group('start')
-            end   = match.group('end')
-        else:
-            start = s
-            end   = s
-
-        # find the genes for a range 
-        results = getGenesForLocationRange( start, end )
-        for g in results: 
-            if (not g in genes):
-                genes.append(g)
+    # find all genes that intersect with the locations
+    genes = get_gene_index()['ranges'].overlapping(ranges[:, 0], ranges[:, 1])
 
-    genes.sort()
     return jsonify({'genes': genes})
     
 #
@@ -489,80 +1700,519 @@ def GenesForLocations(structureid, locations):
 #
 @app.route('/genes/<names>/data/structure/<structureid>')
 def SegmentsForGene(names, structureid):
-    # if the query returns nothing, we return an empty list
-    segments = []
-
-    # find all genes that intersect with the segments
-    conn = db_connect.connect()
-    snames = names.split(',')
-
-    for s in snames:
-        query = conn.execute("SELECT start, end FROM genes WHERE gene_name == ?", s)
-        results = query.cursor.fetchone()
-
-        if (results != None) :
-            g_start = results[0]
-            g_end   = results[1]
-            # print("start: {}".format(g_start))
-            # print("end: {}".format(g_end))
-
-            query = conn.execute("SELECT segid from structure WHERE structureid = ? AND \
-                                      ( ( startid BETWEEN ? AND ? ) OR ( endid BETWEEN ? AND ? ) OR \
-                                        ( startid < ? AND endid > ? ) ) ORDER BY segid", 
-                                      structureid, g_start, g_end, g_start, g_end, g_start, g_end)
-            for b in query.cursor.fetchall():
-                if (b[0] not in segments) :
-                    segments.append(b[0])
+    locations = get_gene_index()['locations']
+
+    starts = []
+    ends   = []
+    for s in names.split(','):
+        if s in locations:
+            starts.append(locations[s][0])
+            ends.append(locations[s][1])
         else:
             print("SegmentsForGene did not find gene: ({})".format(s))
 
-    segments.sort()
+    # find all segments that intersect with the genes
+    segments = get_segment_index(structureid)['ranges'].overlapping(starts, ends)
+
     return jsonify({'segments': segments})
 
 #
-# get a sampled array 
+# spatial queries
+#
+# Each structure's segment centers are put in a KD-tree, built on first
+# use and kept in index_cache (and rebuilt if the database changes). The
+# neighbourhood of one or more segments, of the segments a gene overlaps,
+# or of a point (x,y,z) can then be found with either
+#
+#   ?radius=r   every segment whose center is within r of a query center
+#   ?k=n        the n segments nearest to each query center
+#
+# The query's own segments are part of their neighbourhood. The answer
+# lists the segments found and the genes that overlap them.
+#
+NEIGHBOR_MAX = int(os.environ.get('GTK_NEIGHBOR_MAX', 1000))
+
+def get_spatial_index(structureid):
+    try:
+        structureid = int(structureid)
+    except ValueError:
+        abort(400, "structure ID must be an integer")
+
+    key   = ('spatial', structureid, get_mtime(DB_PATH))
+    index = index_cache.get(key)
+    if (index is None):
+        with index_lock:
+            # another request may have built it while this one waited
+            index = index_cache.get(key)
+            if (index is not None):
+                return index
+
+            columns = dict(get_structure_geometry(structureid))
+            center  = numpy.asarray(columns['center'], dtype=numpy.float64).reshape(-1, 3)
+            with timed('index'):
+                tree = cKDTree(center)
+            index = {
+                'segid'  : numpy.asarray(columns['segid'], dtype=numpy.int64),
+                'startid': numpy.asarray(columns['startid'], dtype=numpy.int64),
+                'endid'  : numpy.asarray(columns['endid'], dtype=numpy.int64),
+                'center' : center,
+                'tree'   : tree
+            }
+            # the tree holds a copy of the points, and about as much again
+            index_cache.put(key, index, 3*center.nbytes + 3*index['segid'].nbytes)
+
+    return index
+
+#
+# the segments near a set of points, and the genes on them
+#
+def neighbors(index, points):
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    radius = request.args.get('radius')
+    k      = request.args.get('k')
+    if (radius is None) == (k is None):
+        abort(400, "give one of radius or k")
+
+    try:
+        radius = float(radius) if radius is not None else None
+        k      = int(k) if k is not None else None
+    except ValueError:
+        abort(400, "radius must be a number, and k an integer")
+    if ((radius is not None) and not (radius >= 0)) or ((k is not None) and not (1 <= k <= NEIGHBOR_MAX)):
+        abort(400, "radius must be at least 0, and k from 1 to {}".format(NEIGHBOR_MAX))
+
+    positions = numpy.zeros(0, dtype=numpy.int64)
+    if len(points) and len(index['segid']):
+        with timed('index'):
+            if radius is not None:
+                found = index['tree'].query_ball_point(points, radius)
+                positions = numpy.concatenate([ numpy.asarray(f, dtype=numpy.int64) for f in found ])
+            else:
+                (distances, found) = index['tree'].query(points, k=min(k, len(index['segid'])))
+                positions = numpy.asarray(found, dtype=numpy.int64).ravel()
+        positions = numpy.unique(positions)
+
+    # hand the segments' locations on to the gene lookup
+    segments = index['segid'][positions]
+    genes    = get_gene_index()['ranges'].overlapping(index['startid'][positions], index['endid'][positions])
+
+    return jsonify({ 'segments': segments.tolist(), 'genes': genes })
+
+#
+# the centers of the segments in a list of (first, last) segment ID ranges
+#
+def segment_centers(index, ranges):
+    ranges = numpy.asarray(ranges, dtype=numpy.int64).reshape(-1, 2)
+    lo     = numpy.searchsorted(index['segid'], ranges[:, 0], side='left')
+    hi     = numpy.searchsorted(index['segid'], ranges[:, 1], side='right')
+
+    positions = [ numpy.arange(l, h) for (l, h) in zip(lo.tolist(), hi.tolist()) if h > l ]
+    return index['center'][numpy.concatenate(positions)] if positions else numpy.zeros((0, 3))
+
+@app.route('/data/structure/<structureid>/neighbors/segment/<segmentids>')
+def NeighborsOfSegments(structureid, segmentids):
+    index = get_spatial_index(structureid)
+
+    return neighbors(index, segment_centers(index, parse_ranges(segmentids)))
+
+@app.route('/data/structure/<structureid>/neighbors/gene/<names>')
+def NeighborsOfGenes(structureid, names):
+    index     = get_spatial_index(structureid)
+    locations = get_gene_index()['locations']
+
+    starts = []
+    ends   = []
+    for s in names.split(','):
+        if s in locations:
+            starts.append(locations[s][0])
+            ends.append(locations[s][1])
+    segids = get_segment_index(structureid)['ranges'].overlapping(starts, ends)
+
+    return neighbors(index, segment_centers(index, [ (s, s) for s in segids ]))
+
+@app.route('/data/structure/<structureid>/neighbors/point/<point>')
+def NeighborsOfPoint(structureid, point):
+    try:
+        xyz = [ float(v) for v in point.split(',') ]
+    except ValueError:
+        xyz = []
+    if len(xyz) != 3:
+        abort(400, "expected a point as x,y,z")
+
+    return neighbors(get_spatial_index(structureid), [xyz])
+
+#
+# windowed summaries of structure arrays
+#
+# A range of an array is split into buckets, and each bucket is reduced
+# to one value: the mean, min or max of its values, or its coverage (the
+# fraction of its values that are not missing). Missing values (NaN) are
+# skipped.
+#
+# Arrays of at least GTK_SUMMARY_MIN values also get cached summary
+# levels: the sum, count, min and max of blocks of 16, 256, 4096, ...
+# values. A wide bucket is then reduced from the blocks inside it and the
+# (less than a block of) values at each end, so a chromosome-wide request
+# reads only a small part of the array. The results are the same as
+# reducing every value (up to the rounding of the sums).
+#
+SUMMARY_TYPES       = ['mean', 'min', 'max', 'coverage']
+SUMMARY_BBI         = {'mean': 'mean', 'min': 'min', 'max': 'max', 'coverage': 'cov'}
+SUMMARY_MIN_LENGTH  = int(os.environ.get('GTK_SUMMARY_MIN', 1 << 16))
+SUMMARY_BLOCK       = 16
+
+#
+# reduce the values between each start and the next (or the end) to
+# (sum, count, min, max)
+#
+def reduce_buckets(values, starts):
+    values  = numpy.asarray(values, dtype=numpy.float64)
+    missing = numpy.isnan(values)
+    return (
+        numpy.add.reduceat(numpy.where(missing, 0.0, values), starts),
+        numpy.add.reduceat(~missing, starts),
+        numpy.fmin.reduceat(values, starts),
+        numpy.fmax.reduceat(values, starts)
+    )
+
+#
+# get the summary levels of one slice of an array, as a list of
+# (block size, sums, counts, mins, maxs), smallest blocks first
+#
+def get_summary_levels(arrayID, arraySlice, info, values):
+    fname  = PROJECT_HOME + "/" + info['url']
+    key    = ('summary', int(arrayID), int(arraySlice), get_mtime(fname))
+    levels = array_cache.get(key)
+    if (levels is None):
+        levels = []
+        with timed('decode'):
+            block = SUMMARY_BLOCK
+            level = reduce_buckets(values, numpy.arange(0, len(values), block))
+            while True:
+                levels.append((block,) + level)
+                if len(level[0]) <= SUMMARY_BLOCK:
+                    break
+
+                starts = numpy.arange(0, len(level[0]), SUMMARY_BLOCK)
+                level  = (
+                    numpy.add.reduceat(level[0], starts),
+                    numpy.add.reduceat(level[1], starts),
+                    numpy.fmin.reduceat(level[2], starts),
+                    numpy.fmax.reduceat(level[3], starts)
+                )
+                block *= SUMMARY_BLOCK
+
+        nbytes = sum(sum(a.nbytes for a in l[1:]) for l in levels)
+        array_cache.put(key, levels, nbytes)
+
+    return levels
+
+#
+# gather the values in [begins, ends) of each bucket into a
+# (buckets x width) matrix, padded with NaN; each range is at most width long
+#
+def gather_ranges(values, begins, ends, width):
+    index   = begins[:, numpy.newaxis] + numpy.arange(width)
+    outside = (index >= ends[:, numpy.newaxis])
+    index   = numpy.where(outside, 0, index)
+    return numpy.where(outside, numpy.nan, numpy.asarray(values[index], dtype=numpy.float64))
+
+#
+# summarise values[begins[i]:ends[i]] for each bucket i, as
+# (sum, count, min, max); the buckets are in order and do not overlap
+#
+def summarise_buckets(arrayID, arraySlice, info, values, begins, ends):
+    width = int((ends - begins).min())
+    if (len(values) < SUMMARY_MIN_LENGTH) or (width < SUMMARY_BLOCK * SUMMARY_BLOCK):
+        # reduce every value
+        window = values[begins[0]:ends[-1]]
+        return reduce_buckets(window, begins - begins[0])
+
+    # use the level with the largest blocks that are still small next to
+    # the buckets, so the ends of each bucket are cheap to read
+    levels = get_summary_levels(arrayID, arraySlice, info, values)
+    (block, sums, counts, mins, maxs) = [l for l in levels if l[0] * l[0] <= width][-1]
+
+    # the whole blocks in each bucket, and the ranges of values at either end
+    first  = -(-begins // block)
+    last   = ends // block
+    blocks = numpy.stack([first, last], axis=1).ravel()[:-1]
+    inner  = [ reduction.reduceat(level[:last[-1]], blocks)[::2] for (reduction, level) in
+                    [(numpy.add, sums), (numpy.add, counts), (numpy.fmin, mins), (numpy.fmax, maxs)] ]
+    edges  = numpy.concatenate([
+                gather_ranges(values, begins, first * block, block),
+                gather_ranges(values, last * block, ends, block)
+            ], axis=1)
+    count('summary_blocks', int((last - first).sum()))
+
+    return (
+        inner[0] + numpy.nansum(edges, axis=1),
+        inner[1] + numpy.count_nonzero(~numpy.isnan(edges), axis=1),
+        numpy.fmin(inner[2], numpy.fmin.reduce(edges, axis=1)),
+        numpy.fmax(inner[3], numpy.fmax.reduce(edges, axis=1))
+    )
+
+#
+# sample windows of bigWig files
+#
+# windows is a list of (file, chromosome, begin, end); returns an array of
+# numsamples values for each. The windows of each file that are not in
+# bbi_cache are read together, with one call to stackup.
+#
+def sample_sequences(windows, numsamples, summary):
+    results = [None] * len(windows)
+    mtimes  = {}
+    missing = {}
+    for (i, (fname, chrom, begin, end)) in enumerate(windows):
+        if fname not in mtimes:
+            mtimes[fname] = get_mtime(fname)
+        key    = ('bbi', fname, mtimes[fname], chrom, begin, end, numsamples, summary)
+        values = bbi_cache.get(key)
+        if (values is None):
+            missing.setdefault(fname, []).append((i, key))
+        else:
+            results[i] = values
+
+    for (fname, entries) in missing.items():
+        (chroms, begins, ends) = zip(*[ windows[i][1:] for (i, key) in entries ])
+        with open_bbi(fname) as handle, timed('bbi'):
+            stack = handle.stackup(list(chroms), list(begins), list(ends), bins=numsamples, summary=SUMMARY_BBI[summary])
+        for ((i, key), row) in zip(entries, stack):
+            values = numpy.array(row)
+            values.setflags(write=False)
+            bbi_cache.put(key, values, values.nbytes)
+            results[i] = values
+
+    return results
+
+#
+# sample a window of a structure array
+#
+# Returns the values in the window, or numsamples buckets of them, each
+# reduced with summary (see summarise_buckets).
+#
+def sample_structure(arrayID, arraySlice, info, begin, end, numsamples, summary):
+    values = get_array_values(arrayID, arraySlice, info)
+    interval = get_slice_interval(arraySlice)
+    sid = int(int(begin)/interval)
+        # add one, to include the final element we want
+    eid = min(int(int(end)/interval) + 1, len(values))
+    buckets = int(numsamples)
+
+    if (eid - sid <= buckets) or (buckets < 1):
+        return values[sid:eid]
+
+    edges = sid + (numpy.arange(buckets + 1) * (eid - sid)) // buckets
+    (sums, counts, mins, maxs) = summarise_buckets(arrayID, arraySlice, info, values, edges[:-1], edges[1:])
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return {
+            'mean'    : sums / counts,
+            'min'     : mins,
+            'max'     : maxs,
+            'coverage': counts / (edges[1:] - edges[:-1])
+        }[summary]
+
+def get_summary_type(summary):
+    if summary not in SUMMARY_TYPES:
+        abort(400, 'summary must be one of: {}'.format(', '.join(SUMMARY_TYPES)))
+    return summary
+
+#
+# get a sampled array
+#
+# Returns at most numsamples values for the range. A structure array with
+# more values than that in the range is binned into numsamples buckets,
+# each reduced with the 'summary' parameter (mean, min, max or coverage;
+# mean by default), as a sequence array is by bbi.
 #
 @app.route('/data/samplearray/<arrayID>/<arraySlice>/<begin>/<end>/<numsamples>')
 def SampleArray(arrayID, arraySlice, begin, end, numsamples):
     array = get_array_metadata(arrayID)
+    summary = get_summary_type(request.args.get('summary', 'mean'))
 
     data = []
     if ( 'sequence' in array['data']['values'][int(arraySlice)] ):
         # there is a sequence array
         adata = array['data']['values'][int(arraySlice)]
         url = "{}/{}".format(PROJECT_HOME, adata['sequence']['url'])
-        data = bbi.fetch(url, adata['sequence']['chrom'], int(begin), int(end), int(numsamples))
-    else:
-        # there is a sequence array
-        array = load_array_data(arrayID, arraySlice)
-        interval = get_dataset_interval()
-        sid = int(int(begin)/interval)
-            # add one, to include the final element we want
-        eid = int(int(end)/interval) + 1
-        data = array['data']['values'][sid:eid]
+        data = sample_sequences([ (url, adata['sequence']['chrom'], int(begin), int(end)) ], int(numsamples), summary)[0]
+    elif (array['type'] != None) and (array['data']['values'][int(arraySlice)]['url'] != ""):
+        # there is a structure array; only the requested window is read
+        info = array['data']['values'][int(arraySlice)]
+        data = sample_structure(arrayID, arraySlice, info, begin, end, numsamples, summary)
 
-    return jsonify({'data': list(data)})
+    data = list(map(
+        lambda d: None if math.isnan(d) else d,
+        numpy.asarray(data).tolist()
+    ))
+
+    return jsonify({'data': data})
 
 #
-# helper function to query genes for a location range
+# get several sampled arrays
 #
-def getGenesForLocationRange( start, end ):
-    conn = db_connect.connect()
+# The body lists the windows to sample, as [arrayID, slice, begin, end]
+# or {"array", "slice", "begin", "end"}, with the number of samples and
+# the summary type shared by all of them:
+#
+#   {"numsamples": int, "summary": string, "queries": [...]}
+#
+# Each window is sampled as by /data/samplearray; the windows of the same
+# bigWig file are read in one pass. Returns {"data": [[...], ...]}, in the
+# order of the queries, or (in binary form) all the values in one
+# 'values' column, with the start of each query's values in 'offsets'.
+#
+@app.route('/data/samplearrays', methods=['POST'])
+def SampleArrays():
+    body = request.get_json(silent=True)
+    if (not isinstance(body, dict)) or (not isinstance(body.get('queries'), list)):
+        abort(400, "expected {\"numsamples\": int, \"queries\": [...]}")
+    queries = body['queries']
+    if len(queries) > BATCH_MAX_QUERIES:
+        abort(400, "too many queries: {} (the limit is {})".format(len(queries), BATCH_MAX_QUERIES))
+    summary = get_summary_type(body.get('summary', 'mean'))
+    try:
+        numsamples = int(body.get('numsamples'))
+        queries = [ (int(q['array']), int(q['slice']), int(q['begin']), int(q['end'])) if isinstance(q, dict) else
+                    tuple(int(v) for v in q) for q in queries ]
+    except (TypeError, ValueError, KeyError):
+        abort(400, "expected numsamples, and [array, slice, begin, end] for each query")
+    if (numsamples < 1) or any(len(q) != 4 for q in queries):
+        abort(400, "expected numsamples, and [array, slice, begin, end] for each query")
+
+    rows    = [ numpy.zeros(0) ] * len(queries)
+    windows = []
+    for (i, (arrayID, arraySlice, begin, end)) in enumerate(queries):
+        # arrays without slices (such as sequence arrays) have no rows
+        array  = get_array_metadata(arrayID)
+        values = array['data'].get('values', [])
+        if not (0 <= arraySlice < len(values)):
+            continue
+
+        info = values[arraySlice]
+        if ( 'sequence' in info ):
+            url = "{}/{}".format(PROJECT_HOME, info['sequence']['url'])
+            windows.append((i, (url, info['sequence']['chrom'], begin, end)))
+        elif (array['type'] != None) and (info['url'] != ""):
+            rows[i] = sample_structure(arrayID, arraySlice, info, begin, end, numsamples, summary)
+
+    if windows:
+        for ((i, window), values) in zip(windows, sample_sequences([ w for (i, w) in windows ], numsamples, summary)):
+            rows[i] = values
+
+    if wants_binary():
+        offsets = numpy.concatenate([ [0], numpy.cumsum([ len(r) for r in rows ]) ]).astype(numpy.int32)
+        values  = numpy.concatenate([ numpy.asarray(r, dtype=numpy.float32) for r in rows ]) if rows else numpy.zeros(0, dtype=numpy.float32)
+        return binary_response([ ('values', values), ('offsets', offsets) ], { 'numsamples': numsamples, 'summary': summary })
+
+    data = [ list(map(
+                lambda d: None if math.isnan(d) else d,
+                numpy.asarray(r).tolist()
+             )) for r in rows ]
+
+    return jsonify({'data': data})
 
-    # find the genes for the entire range
-    query = conn.execute("SELECT gene_name from genes WHERE \
-                            ( start BETWEEN ? AND ? ) OR ( end BETWEEN ? AND ? ) OR \
-                            ( start < ? AND end > ? ) OR ( start == ? ) or ( end == ? ) ORDER BY gene_name", 
-                            start, end, start, end, start, end, start, end)
+#
+# answer several queries in one request
+#
+# The body is a list of paths of GET routes (or of {"path": ...} objects).
+# They are answered in order, sharing this request's database connection
+# and parsed project file, and returned together as
+#
+#   {"results": [{"path": string, "status": int, "data": ...}, ...]}
+#
+# JSON answers are embedded as they are. Other answers (for example
+# binary ones, with ?format=npy) are base64-encoded, and marked with
+# "encoding": "base64". The response is gzip-compressed when the client
+# accepts it.
+#
+# Each query is instrumented on its own; its reads and encoding are then
+# added to the batch request's, but the bytes it produced (which are not
+# sent as they are) and whether it was streamed are not.
+#
+BATCH_MAX_QUERIES = int(os.environ.get('GTK_BATCH_MAX', 100))
+
+@contextlib.contextmanager
+def subquery_instrumentation():
+    if not INSTRUMENT:
+        yield
+        return
+
+    saved = { name: g.pop(name) for name in ['gtk_timings', 'gtk_counts', 'gtk_streamed'] if name in g }
+    try:
+        yield
+    finally:
+        timings = g.pop('gtk_timings', {})
+        counts  = g.pop('gtk_counts', {})
+        g.pop('gtk_streamed', None)
+        for (name, value) in saved.items():
+            setattr(g, name, value)
+
+        batch = g.setdefault('gtk_timings', {})
+        for (phase, seconds) in timings.items():
+            batch[phase] = batch.get(phase, 0.0) + seconds
+        counts.pop('response_bytes', None)
+        for (name, n) in counts.items():
+            count(name, n)
+
+def run_subquery(qpath):
+    result = '{{"path": {}, "status": {}, "data": {}}}'
+    with subquery_instrumentation(), \
+         app.test_request_context(qpath, method='GET', headers={'Accept': request.headers.get('Accept', '*/*')}):
+        try:
+            response = app.make_response(app.dispatch_request())
+        except HTTPException as error:
+            return result.format(json.dumps(qpath), error.code, 'null')
+        except Exception:
+            app.logger.exception("batch query failed: {}".format(qpath))
+            return result.format(json.dumps(qpath), 500, 'null')
+
+        # static files and large lists are streamed; read them in full,
+        # while the query's request is still current
+        response.direct_passthrough = False
+        body = response.get_data()
+        response.close()
+
+    if response.is_json:
+        data = body.decode('utf-8')
+    else:
+        data = '{}, "encoding": "base64"'.format(json.dumps(base64.b64encode(body).decode('ascii')))
+
+    return result.format(json.dumps(qpath), response.status_code, data)
+
+@app.route('/batch', methods=['POST'])
+def Batch():
+    queries = request.get_json(silent=True)
+    if isinstance(queries, dict):
+        queries = queries.get('queries')
+    if not isinstance(queries, list):
+        abort(400, "expected a list of queries")
+    if len(queries) > BATCH_MAX_QUERIES:
+        abort(400, "too many queries: {} (the limit is {})".format(len(queries), BATCH_MAX_QUERIES))
+
+    results = []
+    for q in queries:
+        qpath = q.get('path') if isinstance(q, dict) else q
+        if (not isinstance(qpath, str)) or (not qpath.startswith('/')):
+            results.append('{{"path": {}, "status": 400, "data": null}}'.format(json.dumps(qpath)))
+        else:
+            results.append(run_subquery(qpath))
 
-    genes = []
-    for g in query.cursor.fetchall():
-        if (not g[0] in genes):
-            genes.append(g[0])
+    with timed('serialize'):
+        body = '{{"results": [{}]}}'.format(', '.join(results)).encode('utf-8')
+        response = app.response_class(body, mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        if (request.accept_encodings['gzip'] > 0) and (len(body) > 1024):
+            response.set_data(gzip.compress(body, 6))
+            response.headers['Content-Encoding'] = 'gzip'
 
-    genes.sort()
+    return response
 
-    return genes
+#
+# helper function to query genes for a location range
+#
+def getGenesForLocationRange( start, end ):
+    return get_gene_index()['ranges'].overlapping([int(start)], [int(end)])
 
 
 #
@@ -592,7 +2242,9 @@ if __name__ == '__main__':
         path.join( PROJECT_HOME, 'generated', 'generated-project.db')
     )
 
-    db_connect = create_engine('sqlite:///'+DB_PATH)
+    create_engines()
+    check_schema_version()
+    load_project()
 
     # cd to server directory
     chdir( path.dirname(__file__) )
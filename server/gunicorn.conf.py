@@ -6,3 +6,21 @@
 bind = "127.0.0.1:8000"
 wsgi_app = 'gtkserver:app'
 workers = 4
+
+#
+# read the project file when a worker starts, rather than on its first request
+#
+def post_worker_init(worker):
+    import sys
+    gtkserver = sys.modules.get('gtkserver')
+    if gtkserver is not None:
+        gtkserver.load_project()
+
+#
+# return the worker's pooled database connections when it exits
+#
+def worker_exit(server, worker):
+    import sys
+    gtkserver = sys.modules.get('gtkserver')
+    if gtkserver is not None:
+        gtkserver.db_connect.dispose()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+#
+# Benchmark and load test the gtkserver routes
+#
+# Drives each route against one or more projects (in-process through
+# Flask's test client, or against a running server with --url), and
+# reports p50/p95/p99 latency, throughput and response bytes per route.
+# Each route's requests are sent --repeats times, and each figure is the
+# median over the repeats. Results are written as JSON and can be
+# compared against a saved baseline; the script exits with status 1 when
+# a route's median latency regresses.
+#
+#   bin/generate-project --destination testing/scratch/bench-10k --beads 10000
+#   bin/db_pop testing/scratch/bench-10k
+#   python3 testing/benchmark.py --project testing/scratch/bench-10k --output bench.json
+#   python3 testing/benchmark.py --project testing/scratch/bench-10k --baseline bench.json
+#
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+
+#
+# the routes to exercise. Each entry builds a (method, path, body) request
+# from the project description and a random generator.
+#
+def structure_id(info, rng):
+    return rng.choice(info['structures'])
+
+def segment_range(info, rng, count):
+    first = int(rng.integers(1, max(info['segments'] - count, 1) + 1))
+    return first, min(first + count - 1, info['segments'])
+
+def location_range(info, rng, count):
+    (first, last) = segment_range(info, rng, count)
+    return (first - 1) * info['interval'], last * info['interval']
+
+def array_request(info, rng, path):
+    aid = rng.choice(info['arrays'])
+    return path.format(aid, rng.choice(info['datasets']))
+
+ROUTES = {
+    'segments'          : lambda info, rng: ('GET', '/data/structure/{}/segments'.format(structure_id(info, rng)), None),
+    'segments-npy'      : lambda info, rng: ('GET', '/data/structure/{}/segments?format=npy'.format(structure_id(info, rng)), None),
+    'segmentids'        : lambda info, rng: ('GET', '/data/structure/{}/segmentids'.format(structure_id(info, rng)), None),
+    'unmapped'          : lambda info, rng: ('GET', '/data/structure/{}/unmapped'.format(structure_id(info, rng)), None),
+    'arrays'            : lambda info, rng: ('GET', '/data/arrays/structure', None),
+    'array'             : lambda info, rng: ('GET', array_request(info, rng, '/data/array/{}/{}'), None),
+    'samplearray'       : lambda info, rng: ('GET', array_request(info, rng, '/data/samplearray/{}/{}/') +
+                                                    '{}/{}/100'.format(*location_range(info, rng, 100)), None),
+    'contact-map'       : lambda info, rng: ('GET', '/data/contact-map/{}'.format(rng.choice(info['contactmaps'])), None),
+    'contact-map-npy'   : lambda info, rng: ('GET', '/data/contact-map/{}?format=npy'.format(rng.choice(info['contactmaps'])), None),
+    'contact-map-tile'  : lambda info, rng: ('GET', '/data/contact-map/{}/tile/0/0/0'.format(rng.choice(info['contactmaps'])), None),
+    'genes'             : lambda info, rng: ('GET', '/genes', None),
+    'gene'              : lambda info, rng: ('GET', '/gene/{}'.format(rng.choice(info['genes'])), None),
+    'genes-for-segments': lambda info, rng: ('GET', '/data/structure/{}/segment/{}/genes'.format(
+                                                    structure_id(info, rng),
+                                                    ','.join(str(s) for s in range(*segment_range(info, rng, 20)))), None),
+    'genes-for-locations': lambda info, rng: ('GET', '/data/structure/{}/locations/{}-{}/genes'.format(
+                                                    structure_id(info, rng), *location_range(info, rng, 20)), None),
+    'segments-for-genes': lambda info, rng: ('GET', '/genes/{}/data/structure/{}'.format(
+                                                    ','.join(rng.choice(info['genes'], size=5)), structure_id(info, rng)), None),
+    'setarray'          : lambda info, rng: ('POST', '/data/setarray', {
+                                                    'name': 'benchmark', 'type': 'structure', 'tags': [],
+                                                    'datatype': 'float', 'datadim': 1,
+                                                    'array': rng.random(info['segments']).round(4).tolist() }),
+}
+
+# routes that change the project
+WRITE_ROUTES = ['setarray']
+
+#
+# send requests in-process, through Flask's test client
+#
+class LocalTarget:
+    def __init__(self, project):
+        os.environ['PROJECT_HOME'] = os.path.abspath(project)
+        if SERVER_DIR not in sys.path:
+            sys.path.insert(0, SERVER_DIR)
+
+        # reload, so the module-level paths and caches follow PROJECT_HOME
+        if 'gtkserver' in sys.modules:
+            self.server = importlib.reload(sys.modules['gtkserver'])
+        else:
+            self.server = importlib.import_module('gtkserver')
+        self.local  = threading.local()
+
+    def send(self, method, path, body=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.server.app.test_client()
+        response = self.local.client.open(path, method=method, json=body)
+        return response.status_code, len(response.get_data())
+
+#
+# send requests to a running server (for example gunicorn with
+# server/gunicorn.conf.py)
+#
+class RemoteTarget:
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url      = url.rstrip('/')
+        self.local    = threading.local()
+
+    def send(self, method, path, body=None):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.requests.Session()
+        response = self.local.session.request(method, self.url + path, json=body)
+        return response.status_code, len(response.content)
+
+def fetch_json(target, path):
+    if isinstance(target, LocalTarget):
+        return target.server.app.test_client().get(path).get_json()
+    return target.requests.get(target.url + path).json()
+
+#
+# what the request builders need to know about a project
+#
+def describe_project(target):
+    project = fetch_json(target, '/project/project.json')
+    data    = project['data']
+    genes   = fetch_json(target, '/genes')['genes']
+    arrays  = fetch_json(target, '/data/arrays/structure')['arrays']
+
+    return {
+        'name'       : project['project']['name'],
+        'interval'   : int(project['project']['interval']),
+        'segments'   : int(max(s['num_segments'] for s in data['structure'])),
+        'structures' : [ s['id'] for s in data['structure'] ],
+        'contactmaps': [ c['id'] for c in data['md-contact-map'] ],
+        'arrays'     : [ a['id'] for a in arrays ] or [0],
+        'datasets'   : list(range(len(project['datasets']))),
+        'genes'      : genes or ['none']
+    }
+
+def run_route(target, info, name, iterations, concurrency, repeats, rng):
+    build    = ROUTES[name]
+    requests = [ build(info, rng) for i in range(iterations) ]
+
+    def timed(request):
+        start = time.perf_counter()
+        (status, nbytes) = target.send(*request)
+        return time.perf_counter() - start, status, nbytes
+
+    # warm up caches and connections before measuring
+    target.send(*requests[0])
+
+    # the same requests are sent in each repeat
+    runs = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(timed, requests))
+        elapsed = time.perf_counter() - start
+
+        latency = numpy.array([ s[0] for s in samples ]) * 1000.0
+        runs.append({
+            'p50_ms'    : numpy.percentile(latency, 50),
+            'p95_ms'    : numpy.percentile(latency, 95),
+            'p99_ms'    : numpy.percentile(latency, 99),
+            'mean_ms'   : latency.mean(),
+            'throughput': iterations / elapsed,
+            'errors'    : sum(1 for s in samples if s[1] >= 400)
+        })
+    # the responses are the same in each repeat
+    nbytes  = numpy.array([ s[2] for s in samples ])
+
+    def median(key, digits):
+        return round(float(numpy.median([ run[key] for run in runs ])), digits)
+
+    return {
+        'requests'   : iterations,
+        'repeats'    : repeats,
+        'errors'     : max(run['errors'] for run in runs),
+        'p50_ms'     : median('p50_ms', 3),
+        'p95_ms'     : median('p95_ms', 3),
+        'p99_ms'     : median('p99_ms', 3),
+        'mean_ms'    : median('mean_ms', 3),
+        'throughput' : median('throughput', 1),
+        'mean_bytes' : int(nbytes.mean()),
+        'total_bytes': int(nbytes.sum())
+    }
+
+#
+# compare results against a baseline, returning a list of regressions
+#
+# The median latency is compared: a single run's p95 is set by its few
+# slowest requests, and moves too much from run to run to gate on.
+#
+def compare(results, baseline, tolerance, min_delta):
+    regressions = []
+    for (label, routes) in results['projects'].items():
+        for (name, current) in routes.items():
+            previous = baseline.get('projects', {}).get(label, {}).get(name)
+            if previous is None:
+                continue
+            limit = max(previous['p50_ms'] * (1.0 + tolerance), previous['p50_ms'] + min_delta)
+            if (current['p50_ms'] > limit) or (current['errors'] > previous['errors']):
+                regressions.append('{} {}: p50 {:.3f}ms (baseline {:.3f}ms), errors {} (baseline {})'.format(
+                    label, name, current['p50_ms'], previous['p50_ms'], current['errors'], previous['errors']))
+    return regressions
+
+def print_table(label, routes):
+    print('')
+    print(label)
+    print('    {:<20} {:>7} {:>9} {:>9} {:>9} {:>10} {:>12}'.format(
+        'route', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'bytes'))
+    for (name, r) in routes.items():
+        print('    {:<20} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f} {:>12}'.format(
+            name, r['errors'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['throughput'], r['mean_bytes']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description="benchmark: measure gtkserver route latency and throughput",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+
+    parser.add_argument(    "--project",
+                            action="append",
+                            default=[],
+                            help="project directory with a built database (repeat for several projects)")
+
+    parser.add_argument(    "--url",
+                            required=False,
+                            default=None,
+                            help="benchmark a running server instead of the in-process test client")
+
+    parser.add_argument(    "--routes",
+                            required=False,
+                            default=",".join(r for r in ROUTES if r not in WRITE_ROUTES),
+                            help="comma-separated routes to run ({})".format(", ".join(ROUTES)))
+
+    parser.add_argument(    "--writes",
+                            action="store_true",
+                            help="also run the routes that change the project (in-process runs use a copy of the project)")
+
+    parser.add_argument(    "--iterations",
+                            type=int,
+                            default=100,
+                            help="requests per route, in each repeat")
+
+    parser.add_argument(    "--repeats",
+                            type=int,
+                            default=5,
+                            help="times to send each route's requests; the results are the medians over the repeats")
+
+    parser.add_argument(    "--concurrency",
+                            type=int,
+                            default=1,
+                            help="number of requests in flight at once")
+
+    parser.add_argument(    "--seed",
+                            type=int,
+                            default=0,
+                            help="random seed for the request parameters")
+
+    parser.add_argument(    "--output",
+                            required=False,
+                            default=None,
+                            help="file to write the results to, as JSON")
+
+    parser.add_argument(    "--baseline",
+                            required=False,
+                            default=None,
+                            help="results file to compare against")
+
+    parser.add_argument(    "--tolerance",
+                            type=float,
+                            default=0.25,
+                            help="allowed fractional increase in median latency over the baseline")
+
+    parser.add_argument(    "--min-delta",
+                            type=float,
+                            default=2.0,
+                            help="ignore median latency increases smaller than this many milliseconds")
+
+    args = parser.parse_args()
+
+    if (not args.project) and (args.url is None):
+        parser.error("give at least one --project, or --url")
+    if (args.iterations < 1) or (args.repeats < 1):
+        parser.error("--iterations and --repeats must be at least 1")
+
+    routes = [ r for r in args.routes.split(',') if r ]
+    if args.writes:
+        routes += [ r for r in WRITE_ROUTES if r not in routes ]
+    for r in routes:
+        if r not in ROUTES:
+            parser.error("unknown route: {}".format(r))
+
+    results = {
+        'created'    : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'iterations' : args.iterations,
+        'repeats'    : args.repeats,
+        'concurrency': args.concurrency,
+        'projects'   : {}
+    }
+
+    scratch = None
+    targets = []
+    if args.url is not None:
+        targets.append(RemoteTarget(args.url))
+    for project in args.project:
+        if args.writes:
+            # setarray adds files and rows to the project, so work on a copy
+            scratch = scratch or tempfile.mkdtemp(prefix='gtk-benchmark-')
+            copy    = os.path.join(scratch, os.path.basename(os.path.abspath(project)))
+            shutil.copytree(project, copy)
+            os.makedirs(os.path.join(copy, 'source', 'array'), exist_ok=True)
+            project = copy
+        targets.append(project)
+
+    try:
+        for target in targets:
+            if not isinstance(target, RemoteTarget):
+                target = LocalTarget(target)
+            info  = describe_project(target)
+            label = '{} ({} segments)'.format(info['name'], info['segments'])
+            rng   = numpy.random.default_rng(args.seed)
+
+            results['projects'][label] = {}
+            for name in routes:
+                results['projects'][label][name] = run_route(target, info, name, args.iterations, args.concurrency, args.repeats, rng)
+            print_table(label, results['projects'][label])
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch)
+
+    if args.output is not None:
+        with open(args.output, 'w') as ofile:
+            json.dump(results, ofile, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as bfile:
+            regressions = compare(results, json.load(bfile), args.tolerance, args.min_delta)
+        print('')
+        if regressions:
+            print('REGRESSIONS:')
+            for r in regressions:
+                print('    ' + r)
+            sys.exit(1)
+        print('no regressions against {}'.format(args.baseline))
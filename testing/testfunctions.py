@@ -2,6 +2,8 @@
 # Imported by the test_gentk.py and test_gentk_production.py scripts
 #
 
+import numpy
+
 client = None
 
 def set_client(new_client, project):
@@ -143,6 +145,64 @@ def test_get_array():
         assert (result['tags'] == t['tags'])
         assert (result['data']['values'] == t['values'])
 
+def test_get_array_numpy():
+    for (aid, aslice) in [(0, 0), (0, 1), (1, 0)]:
+        gold   = client.get_array(aid, aslice)
+        result = client.get_array_numpy(aid, aslice)
+        assert (result.tolist() == gold['data']['values'])
+
+    # missing arrays are empty
+    assert (len(client.get_array_numpy(10000, 10000)) == 0)
+
+def test_get_structure_numpy():
+    for sid in [0, 1]:
+        gold   = client.get_structure(sid)['segments']
+        result = client.get_structure_numpy(sid)
+        assert (len(result['segid']) == len(gold))
+        assert (result['segid'].tolist() == [s['segid'] for s in gold])
+        assert (result['startid'].tolist() == [s['startid'] for s in gold])
+        assert (result['start'].tolist() == [s['start'] for s in gold])
+        assert (result['end'].tolist() == [s['end'] for s in gold])
+
+    # missing structures are empty
+    assert (len(client.get_structure_numpy(-1)['segid']) == 0)
+
+def test_get_contactmap_numpy():
+    gold   = client.get_contactmap(0)['contacts']
+    result = client.get_contactmap_numpy(0)
+    assert (len(result['x']) == len(gold))
+    assert (result['x'][0] == gold[0]['x'])
+    assert (result['y'][0] == gold[0]['y'])
+    assert (abs(result['value'][0] - gold[0]['value']) < 1e-6)
+
+def test_iter_contactmap():
+    gold   = client.get_contactmap(0)['contacts']
+    result = list(client.iter_contactmap(0))
+    assert (result == gold)
+    assert (list(client.iter_genes()) == client.get_genes()['genes'])
+
+def test_get_contactmap_tiles():
+    tiles = client.get_contactmap_tiles(0)
+    assert (len(tiles['levels']) > 0)
+    assert (tiles['levels'][-1]['bin_size'] == 1)
+
+    # at the finest zoom, the tiles hold the records of the contact map
+    zoom  = tiles['levels'][-1]['zoom']
+    gold  = { (c['x'], c['y']): c['value'] for c in client.get_contactmap(0)['contacts'] if c['value'] is not None }
+    ntile = (tiles['size'] - 1) // tiles['tile_size'] + 1
+    result = {}
+    for tx in range(ntile):
+        for ty in range(ntile):
+            for c in client.get_contactmap_tile(0, zoom, tx, ty)['contacts']:
+                result[(c['x'], c['y'])] = c['value']
+
+    assert (result.keys() == gold.keys())
+    for key in gold:
+        assert (abs(result[key] - gold[key]) < 1e-5)
+
+    # an empty map has no levels
+    assert (client.get_contactmap_tiles(-1)['levels'] == [])
+
 def test_get_genes_for_segments():
     tests = [
                 {
@@ -222,6 +282,13 @@ def test_get_genes_for_segments():
     for t in tests:
         result = client.get_genes_for_segments(t["structure"], t["segment"])
         assert (result['genes'] == t["gold"])
+
+def test_get_genes_for_segment_ranges_past_the_end():
+    # a range is clamped to the segments that exist (the last is 11)
+    result = client.get_genes_for_segments(0, "2-30")
+    assert (len(result['genes']) > 0)
+    assert (result['genes'] == client.get_genes_for_segments(0, "2-11")['genes'])
+    assert (client.get_genes_for_segments(0, "0-3")['genes'] == client.get_genes_for_segments(0, "1-3")['genes'])
     
 def test_get_genes_for_locations():
     tests = [
@@ -306,6 +373,27 @@ def test_get_segments_for_genes():
         result = client.get_segments_for_genes(t["structure"], t["gene"])
         assert (result['segments'] == t["gold"]) 
 
+def test_get_neighbors():
+    # every segment is its own nearest neighbour
+    result = client.get_neighbors_of_segments(0, "5", k=1)
+    assert (result['segments'] == [5])
+
+    # a large enough radius holds the whole structure
+    segments = client.get_segment_ids(0)['segmentids']
+    result   = client.get_neighbors_of_segments(0, "5", radius=1e9)
+    assert (result['segments'] == sorted(segments))
+
+    # the genes are those on the segments found
+    result = client.get_neighbors_of_segments(0, "8", k=3)
+    assert (len(result['segments']) == 3)
+    gold   = client.get_genes_for_segments(0, ",".join(str(s) for s in result['segments']))
+    assert (result['genes'] == gold['genes'])
+
+    structure = client.get_structure_numpy(0)
+    point     = structure['center'][structure['segid'] == 3][0]
+    result    = client.get_neighbors_of_point(0, point, k=1)
+    assert (result['segments'] == [3])
+
 def test_set_array():
     tests = [
                 {
@@ -339,7 +427,28 @@ def test_set_array():
             assert (result['data']['values'] != t['wrongvals'])
 
     arrays = client.get_arrays('structure')
-    assert(arrays['arrays'][t['structurearrayid']] == {'id': 8, 'max': None, 'min': None, 'type': 'structure', 'name': 'test set array'})
+    assert(arrays['arrays'][t['structurearrayid']] == {'id': 8, 'max': 5, 'min': 0, 'type': 'structure', 'name': 'test set array'})
+
+def test_set_array_numpy():
+    metadata = { "name": "test set array numpy", "type": "structure", "tags": ["a", "b"], "datatype": "float", "datadim": 1 }
+    values   = numpy.array([0.5, 1.5, numpy.nan, 3.5])
+
+    # one array, shared by every dataset
+    arrayid = client.set_array(values, metadata)
+    for i in [0, 1]:
+        result = client.get_array(arrayid, i)
+        assert (result['name'] == metadata['name'])
+        assert (result['tags'] == metadata['tags'])
+        assert (result['data']['values'] == [0.5, 1.5, None, 3.5])
+
+    # one array for each dataset; each upload gets a new ID
+    perdataset = client.set_array({ 0: values[:2], 1: numpy.arange(3, dtype=numpy.int32) }, metadata)
+    assert (perdataset == arrayid + 1)
+    assert (client.get_array(perdataset, 0)['data']['values'] == [0.5, 1.5])
+    assert (client.get_array(perdataset, 1)['data']['values'] == [0, 1, 2])
+
+    arrays = { a['id']: a for a in client.get_arrays('structure')['arrays'] }
+    assert ((arrays[perdataset]['min'], arrays[perdataset]['max']) == (0, 2))
 
 def test_get_arrays():
     tests = [
@@ -364,6 +473,36 @@ def test_get_sampled_array():
     array = client.get_sampled_array(7, 1, 0, 200000, 52)
     assert(len(array['data']) == 52)
 
+    # a structure array is binned when the range has more values than samples
+    tests = [
+                { 'summary': None,       'data': [1.5, 4, 7, 10] },
+                { 'summary': 'min',      'data': [1, 3, 6, 9] },
+                { 'summary': 'max',      'data': [2, 5, 8, 11] },
+                { 'summary': 'coverage', 'data': [1, 1, 1, 1] }
+            ]
+    for t in tests:
+        array = client.get_sampled_array(0, 0, 0, 4400000, 4, t['summary'])
+        assert(array['data'] == t['data'])
+
+    array = client.get_sampled_array(0, 0, 0, 4400000, 20)
+    assert(array['data'] == [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11])
+
+def test_get_sampled_arrays():
+    queries = [(7, 0, 0, 200000), (7, 1, 100, 300), (0, 0, 0, 4400000)]
+    result  = client.get_sampled_arrays(queries, 4)
+    assert (len(result) == len(queries))
+    for (q, values) in zip(queries, result):
+        gold = client.get_sampled_array(*q, 4)['data']
+        assert (numpy.allclose(values, gold))
+
+    result = client.get_sampled_arrays([(0, 0, 0, 4400000)], 4, 'max')
+    assert (result[0].tolist() == [2, 5, 8, 11])
+
+    # array 4 is a sequence array, with no slices; the rest of the batch is answered
+    result = client.get_sampled_arrays([(4, 0, 0, 200000), (0, 0, 0, 4400000)], 4, 'max')
+    assert (len(result[0]) == 0)
+    assert (result[1].tolist() == [2, 5, 8, 11])
+
 def test_get_segment_ids():
     tests = [
                 { 
@@ -384,3 +523,39 @@ def test_get_datset_ids():
     for t in tests:
         ids = client.get_dataset_ids()
         assert(t['ids'] == ids)
+
+def test_batch():
+    paths   = ['/project/interval', '/datasets', '/data/structure/0/segmentids', '/data/contact-map/0', '/data/nothing']
+    results = client.batch(paths)
+
+    assert ([r['path'] for r in results] == paths)
+    assert (results[0]['data'] == client.get_project_interval())
+    assert (results[1]['data'] == client.get_dataset_ids())
+    assert (results[2]['data'] == client.get_segment_ids(0))
+    assert (results[3]['data'] == client.get_contactmap(0))
+    assert (results[4]['status'] == 404)
+
+def test_get_arrays_for_all_datasets():
+    result = client.get_arrays_for_all_datasets(0)
+    assert (list(result.keys()) == sorted(client.get_dataset_ids()))
+    # slice i of an array is the i'th dataset, in ID order
+    for (i, values) in enumerate(result.values()):
+        assert (values.tolist() == client.get_array(0, i)['data']['values'])
+
+def test_get_structures():
+    result = client.get_structures([0, 1])
+    for (s, columns) in result.items():
+        gold = client.get_structure(s)['segments']
+        assert (columns['segid'].tolist() == [g['segid'] for g in gold])
+
+def test_cached_client():
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cached = type(client)(client.url, client.port, cache_dir=cache_dir)
+        first  = cached.get_contactmap(0)
+        assert (len(os.listdir(cache_dir)) == 1)
+
+        # the second answer is a 304, served from the cache
+        assert (cached.get_contactmap(0) == first)
+        assert (first == client.get_contactmap(0))